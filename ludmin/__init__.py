@@ -1,12 +1,52 @@
 import os
-from flask import Flask, jsonify, request, g
+import threading
+from flask import Flask, Response, jsonify, request, g
 from flask_pymongo import PyMongo
 
 from config import config
-from .tokens.token import Token
+from .tokens.token import Token, token_cache
+from .indexes import check_indexes
+from .querylog import query_log
+from .common import Hasher, metrics, limiter, serializer, json_body
 
 # Flask extensions
 mongo = PyMongo()
+hasher = Hasher()
+
+
+def configure_extensions(app):
+    """Set up the extensions from the app config (again when the config changes, as the benchmark does)"""
+    from .users.touches import touches
+    from .users.profiles import profiles
+
+    # the query log listens to the clients created after it
+    query_log.init_app(app)
+    hasher.init_app(app)
+    serializer.init_app(app)
+
+    # devices' lastUsed write-behind buffer
+    touches.init_app(app)
+
+    # public profiles cache, invalidated by this process' updates
+    profiles.init_app(app)
+
+    # concurrency and rate limits of the password hashing endpoints
+    limiter.init_app(app)
+
+    # verified tokens cache, expired tokens are kept while they can still be refreshed
+    token_cache.configure(
+        app.config.get('TOKEN_CACHE_SIZE', 10000),
+        app.config.get('TOKEN_CACHE_EXPIRED_GRACE', app.config['TOKEN_TIMEOUT'])
+    )
+
+    # latency by endpoint and phase, status codes and the caches' stats on /metrics
+    metrics.init_app(app)
+    metrics.add_stats('token_cache', token_cache.stats)
+    metrics.add_stats('hasher', hasher.stats)
+    metrics.add_stats('touches', touches.stats)
+    metrics.add_stats('profiles', profiles.stats)
+    metrics.add_stats('queries', query_log.stats)
+    metrics.add_stats('limiter', limiter.stats)
 
 
 def create_app(config_name=None):
@@ -16,8 +56,14 @@ def create_app(config_name=None):
     app.config.from_object(config[config_name])
 
     # Initialize flask extensions
+    configure_extensions(app)
     mongo.init_app(app)
 
+    # warn about missing indexes without blocking the startup
+    if app.config.get('CHECK_INDEXES', True):
+        with app.app_context():
+            threading.Thread(target=check_indexes, args=(app, mongo.db), daemon=True).start()
+
     # Register API routes
     from .tokens.resources import tokens_bp
     app.register_blueprint(tokens_bp, url_prefix='/tokens')
@@ -38,8 +84,10 @@ def create_app(config_name=None):
 
     @app.before_request
     def global_validations():
+        metrics.start_request()
+
         # check the body is not empty when not using GET/DELETE
-        if request.method != 'GET' and request.method != 'DELETE' and request.method != 'OPTIONS' and not request.get_json():
+        if request.method != 'GET' and request.method != 'DELETE' and request.method != 'OPTIONS' and not json_body():
             return jsonify({"error": "Invalid request."})
 
         # store the token for this request (when available)
@@ -47,16 +95,30 @@ def create_app(config_name=None):
 
         # validate the token for any route that is not requesting a new token
         rule = request.url_rule
-        if request.method != 'OPTIONS' and rule and '/token' not in rule.rule:
+        if request.method != 'OPTIONS' and rule and '/token' not in rule.rule and rule.rule != '/metrics':
             try:
                 g.token.decode_token_or_fail()
             except Exception as e:
                 # immediate fail for any issue with the token
                 return jsonify({'error': str(e)}), 500
 
+    if metrics.enabled:
+        @app.route('/metrics')
+        def metrics_endpoint():
+            return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    from .users import repository
+
     # hack
     @app.after_request
     def after_request(response):
+        # database round trips of this request, for tests and profiling
+        if app.config.get('ROUND_TRIPS_HEADER'):
+            response.headers['X-DB-Round-Trips'] = str(repository.round_trips())
+
+        metrics.finish_request(response)
+        query_log.finish_request(response)
+
         response.headers.add('Access-Control-Allow-Origin', '*')
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
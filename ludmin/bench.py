@@ -0,0 +1,661 @@
+"""
+Endpoints benchmark: builds the app with the testing config against an in-memory Mongo stand-in
+(mongomock) or a disposable mongod, seeds realistic data and times the hot endpoints.
+"""
+import asyncio
+import json
+import platform
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId, json_util
+from pymongo import MongoClient, uri_parser
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from . import create_app
+from .indexes import ensure_indexes
+from .users.repository import email_fields, FULL_PROFILE, LISTING
+
+SCENARIOS = ['public_token', 'login', 'refresh', 'logout', 'profile', 'devices', 'emails', 'list', 'reset_request',
+             'reset']
+
+
+def build_app(mongo_uri=None, overrides=None):
+    """Testing app using mongomock, or the database of mongo_uri (dropped, must be named *bench*)"""
+    app = create_app('testing')
+    app.config.update(overrides or {})
+
+    if mongo_uri:
+        database = uri_parser.parse_uri(mongo_uri).get('database') or 'ludmin_bench'
+        if 'bench' not in database:
+            raise ValueError('The benchmark database is dropped, its name must include "bench"')
+        client = MongoClient(mongo_uri, tz_aware=True)
+        db = client[database]
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            raise RuntimeError('mongomock is required to benchmark without a mongod (pip install mongomock)')
+        client = mongomock.MongoClient(tz_aware=True)
+        db = client['ludmin_bench']
+
+    app.extensions['pymongo']['MONGO'] = (client, db)
+    client.drop_database(db.name)
+
+    # extensions configured from the app config are set up again with the overrides
+    from . import configure_extensions
+    from .tokens.token import token_cache
+    configure_extensions(app)
+    token_cache.clear()
+
+    return app, db
+
+
+def seed(db, users=1000, devices=10, emails=5, passwords=10, resets=0.1):
+    """
+    Users with long histories: `devices` sessions, `emails` emails and `passwords` passwords each
+    (the last ones are the current), plus outstanding reset requests for a share of them.
+    Hashes are shared between users, the verification cost is the same.
+    """
+    timestamp = datetime.now(timezone.utc)
+    hashes = [generate_password_hash('password-%d' % index) for index in range(passwords)]
+
+    # mongomock does not use indexes (and can not build the unique multikey email ones)
+    if isinstance(db.client, MongoClient):
+        ensure_indexes(db)
+
+    seeded = []
+    for start in range(0, users, 500):
+        batch = []
+        for index in range(start, min(start + 500, users)):
+            batch.append({
+                'full_name': 'User %d' % index,
+                'emails': [{
+                    'email': 'user%d.%d@bench.test' % (index, position),
+                    'verified': False,
+                    'current': position == emails - 1,
+                    'insertedAt': timestamp,
+                } for position in range(emails)],
+                'passwords': [{
+                    'current': position == passwords - 1,
+                    'password': hashes[position],
+                    'insertedAt': timestamp,
+                } for position in range(passwords)],
+                'insertedAt': timestamp,
+            })
+            batch[-1].update(email_fields(batch[-1]['emails']))
+        db.users.insert_many(batch)
+
+        for user in batch:
+            user_devices = [uuid.uuid4().hex for _ in range(devices)]
+            seeded.append({
+                '_id': user['_id'],
+                'email': user['emails'][-1]['email'],
+                'password': 'password-%d' % (passwords - 1),
+                'devices': user_devices,
+            })
+            if user_devices:
+                db.sessions.insert_many([{
+                    'user_id': user['_id'],
+                    'device_id': device_id,
+                    'rev': random.randint(0, 9999),
+                    'lastUsed': timestamp,
+                    'description': 'Bench device',
+                } for device_id in user_devices])
+
+    outstanding = [{
+        'email': user.get('email'),
+        'sent': False,
+        'enabled': True,
+        'failures': 0,
+        'code': str(random.randint(1000, 9999)),
+        'insertedAt': timestamp,
+        'expiresAt': timestamp + timedelta(hours=1),
+    } for user in random.sample(seeded, int(len(seeded) * resets))]
+    if outstanding:
+        db.reset_requests.insert_many(outstanding)
+
+    return seeded
+
+
+class Runner:
+    """Issues the scenarios' requests through the test client"""
+    def __init__(self, app, db, users):
+        self.app = app
+        self.db = db
+        self.users = users
+        self.client = app.test_client()
+
+    def request(self, method, url, body=None, token=None):
+        headers = {'Authorization': 'Bearer %s' % token} if token else {}
+        response = getattr(self.client, method)(
+            url,
+            data=json.dumps(body) if body is not None else None,
+            content_type='application/json',
+            headers=headers
+        )
+        data = json.loads(response.get_data(as_text=True) or '{}') if response.mimetype == 'application/json' else {}
+        return response.status_code, data
+
+    def public_token(self, device_id=None):
+        return self.request('post', '/tokens/public', {'device_id': device_id or uuid.uuid4().hex})[1].get('token')
+
+    def login(self, user, device_id=None):
+        device_id = device_id or uuid.uuid4().hex
+        status, data = self.request('post', '/tokens', {
+            'email': user.get('email'),
+            'password': user.get('password'),
+            'description': 'Bench',
+        }, self.public_token(device_id))
+        return device_id, data.get('token')
+
+    # each scenario returns a setup (not timed) and the timed request
+    def scenario(self, name):
+        user = random.choice(self.users)
+
+        if name == 'public_token':
+            return lambda: self.request('post', '/tokens/public', {'device_id': uuid.uuid4().hex})
+
+        if name == 'login':
+            token = self.public_token()
+            return lambda: self.request('post', '/tokens', {
+                'email': user.get('email'),
+                'password': user.get('password'),
+                'description': 'Bench',
+            }, token)
+
+        if name == 'refresh':
+            device_id, token = self._logged(user)
+            def refresh():
+                status, data = self.request('get', '/tokens/%s' % device_id, token=token)
+                user['tokens'][device_id] = data.get('token')
+                return status, data
+            return refresh
+
+        if name == 'logout':
+            device_id, token = self.login(user)
+            return lambda: self.request('delete', '/tokens/%s' % device_id, token=token)
+
+        if name == 'profile':
+            device_id, token = self._logged(user)
+            other = random.choice(self.users)
+            target = 'me' if random.random() < 0.5 else str(other.get('_id'))
+            return lambda: self.request('get', '/users/%s' % target, token=token)
+
+        if name in ('devices', 'emails'):
+            device_id, token = self._logged(user)
+            return lambda: self.request('get', '/users/me/%s?limit=10' % name, token=token)
+
+        if name == 'list':
+            device_id, token = self._logged(user)
+            return lambda: self.request('get', '/users?limit=100', token=token)
+
+        if name == 'reset_request':
+            token = self.public_token()
+            return lambda: self.request('post', '/users/reset', {'email': user.get('email')}, token)
+
+        if name == 'reset':
+            token = self.public_token()
+            code = str(random.randint(1000, 9999))
+            self.db.reset_requests.update_many({'email': user.get('email')}, {'$set': {'enabled': False}})
+            self.db.reset_requests.insert_one({
+                'email': user.get('email'), 'sent': False, 'enabled': True, 'failures': 0, 'code': code,
+                'expiresAt': datetime.now(timezone.utc) + timedelta(hours=1),
+            })
+            return lambda: self.request('put', '/users/reset', {
+                'email': user.get('email'),
+                'code': code,
+                'password': user.get('password'),
+                'password_confirmation': user.get('password'),
+            }, token)
+
+        raise ValueError('Unknown scenario %s' % name)
+
+    def _logged(self, user):
+        # logged-in tokens are reused between iterations, refresh keeps them current
+        tokens = user.setdefault('tokens', {})
+        if not tokens:
+            device_id, token = self.login(user)
+            tokens[device_id] = token
+        device_id = random.choice(list(tokens))
+        return device_id, tokens[device_id]
+
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_scenario(runner, name, requests):
+    latencies = []
+    cpu = 0.0
+    statuses = {}
+    for _ in range(requests):
+        timed = runner.scenario(name)
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        status, data = timed()
+        cpu += time.process_time() - cpu_started
+        latencies.append(time.perf_counter() - started)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        'requests': requests,
+        'throughput_rps': requests / total if total else 0.0,
+        'mean_ms': 1000 * total / requests if requests else 0.0,
+        'cpu_ms': 1000 * cpu / requests if requests else 0.0,
+        'p50_ms': 1000 * _percentile(latencies, 50),
+        'p99_ms': 1000 * _percentile(latencies, 99),
+        'statuses': statuses,
+    }
+
+
+def run(scenarios=None, requests=200, users=1000, devices=10, emails=5, passwords=10, mongo_uri=None,
+        overrides=None):
+    """Seed and run the scenarios, returns machine readable results"""
+    app, db = build_app(mongo_uri, overrides)
+    seeded = seed(db, users, devices, emails, passwords)
+    runner = Runner(app, db, seeded)
+
+    results = {}
+    for name in scenarios or SCENARIOS:
+        results[name] = run_scenario(runner, name, requests)
+
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'backend': 'mongod' if mongo_uri else 'mongomock',
+            'users': users,
+            'devices': devices,
+            'emails': emails,
+            'passwords': passwords,
+            'overrides': overrides or {},
+        },
+        'results': results,
+    }
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+async def _refresh_load(base_url, devices, requests):
+    """Concurrent refreshes, one worker per [device_id, token] (the token is replaced by the refreshed one)"""
+    from aiohttp import ClientSession
+
+    latencies = []
+    statuses = {}
+    types = {}
+    remaining = [requests]
+
+    async def worker(session, device):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = time.perf_counter()
+            async with session.get('%s/tokens/%s' % (base_url, device[0]),
+                                   headers={'Authorization': 'Bearer %s' % device[1]}) as response:
+                data = await response.json()
+            latencies.append(time.perf_counter() - started)
+            statuses[str(response.status)] = statuses.get(str(response.status), 0) + 1
+            types[data.get('type')] = types.get(data.get('type'), 0) + 1
+            device[1] = data.get('token', device[1])
+
+    async with ClientSession() as session:
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(session, device) for device in devices])
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'concurrency': len(devices),
+        'throughput_rps': requests / elapsed if elapsed else 0.0,
+        'p50_ms': 1000 * _percentile(latencies, 50),
+        'p99_ms': 1000 * _percentile(latencies, 99),
+        'statuses': statuses,
+        'types': types,
+    }
+
+
+def compare_refresh(mongo_uri, concurrency=50, requests=2000, users=1000):
+    """
+    Concurrent refresh throughput of the sync blueprint (threaded server) and the asyncio mode
+    (aiohttp + motor, needs a mongod) on the same seeded database, served one after the other.
+    """
+    from .tokens.aio import create_aio_app
+    from aiohttp import web
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    app, db = build_app(mongo_uri)
+    runner = Runner(app, db, seed(db, users, devices=1))
+    devices = [list(runner.login(random.choice(runner.users))) for _ in range(concurrency)]
+
+    results = {}
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        results['sync'] = asyncio.run(_refresh_load('http://127.0.0.1:%d' % server.server_port, devices, requests))
+    finally:
+        server.shutdown()
+
+    async def run_async():
+        aio_app = create_aio_app('testing', AsyncIOMotorClient(mongo_uri, tz_aware=True)[db.name])
+        site_runner = web.AppRunner(aio_app)
+        await site_runner.setup()
+        site = web.TCPSite(site_runner, '127.0.0.1', 0)
+        await site.start()
+        port = site_runner.addresses[0][1]
+        try:
+            return await _refresh_load('http://127.0.0.1:%d' % port, devices, requests)
+        finally:
+            await site_runner.cleanup()
+
+    results['async'] = asyncio.run(run_async())
+
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'users': users,
+            'concurrency': concurrency,
+        },
+        'results': results,
+    }
+
+
+def compare_encoders(users=1000, devices=10, emails=5, passwords=10, repeat=50):
+    """
+    Encoding time of the largest payloads (an user with its histories and a max size users page) with every
+    installed JSON encoder, checking each one decodes to the same JSON as bson.json_util.
+    """
+    from .common.serializer import ENCODERS
+
+    app, db = build_app()
+    seeded = seed(db, users, devices, emails, passwords, resets=0)
+    user = db.users.find_one({'_id': seeded[0]['_id']}, FULL_PROFILE)
+    payloads = {
+        'profile': {'success': True, 'profile': dict(
+            user, user_id=str(user.pop('_id')),
+            devices=list(db.sessions.find({'user_id': seeded[0]['_id']}, {'_id': 0}))
+        )},
+        'list': {'success': True, 'users': list(db.users.find({}, LISTING).limit(app.config['PAGE_SIZE_MAX']))},
+    }
+
+    results = {}
+    for payload_name, payload in payloads.items():
+        expected = json.loads(json_util.dumps(payload))
+        results[payload_name] = {}
+        for name, dumps in ENCODERS.items():
+            if dumps is None:
+                continue
+
+            latencies = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                encoded = dumps(payload)
+                latencies.append(time.perf_counter() - started)
+
+            latencies.sort()
+            results[payload_name][name] = {
+                'mean_ms': 1000 * sum(latencies) / repeat,
+                'p50_ms': 1000 * _percentile(latencies, 50),
+                'p99_ms': 1000 * _percentile(latencies, 99),
+                'bytes': len(encoded.encode('utf-8')),
+                'same_json': json.loads(encoded) == expected,
+            }
+
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'users': users,
+            'devices': devices,
+            'emails': emails,
+            'passwords': passwords,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def _reqparse_parser(fields):
+    # the previous per request parsing: a new parser and its arguments on every call
+    from flask_restful import reqparse
+
+    parser = reqparse.RequestParser()
+    for name in fields:
+        parser.add_argument(name, required=True)
+    return parser.parse_args()
+
+
+def compare_parsing(repeat=2000):
+    """
+    Body parsing time of the login, public token and signup requests: reqparse parsers built per request
+    against the precompiled schemas (the refresh path reads no body, only the token).
+    """
+    from .common.schema import json_body
+    from .tokens.resources import LOGIN, PUBLIC
+    from .users.usersResource import SIGNUP
+
+    app = create_app('testing')
+    bodies = {
+        'login': (LOGIN, {'email': 'user@bench.test', 'password': 'password-9', 'description': 'Bench device'}),
+        'public_token': (PUBLIC, {'device_id': uuid.uuid4().hex}),
+        'signup': (SIGNUP, {'full_name': 'Bench User', 'email': 'user@bench.test', 'password': 'password-9',
+                            'password_confirmation': 'password-9'}),
+    }
+
+    results = {}
+    for name, (schema, body) in bodies.items():
+        fields = [field[0] for field in schema.fields]
+        parsers = {
+            'reqparse': lambda: _reqparse_parser(fields),
+            'schema': schema.parse,
+        }
+        results[name] = {}
+        for parser_name, parse in parsers.items():
+            latencies = []
+            for _ in range(repeat):
+                with app.test_request_context(method='POST', data=json.dumps(body), content_type='application/json'):
+                    started = time.perf_counter()
+                    json_body()
+                    parse()
+                    latencies.append(time.perf_counter() - started)
+
+            latencies.sort()
+            results[name][parser_name] = {
+                'mean_us': 1000000 * sum(latencies) / repeat,
+                'p50_us': 1000000 * _percentile(latencies, 50),
+                'p99_us': 1000000 * _percentile(latencies, 99),
+            }
+
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def compare_tokens(requests=500, users=100):
+    """
+    CPU time per request of the token checks with the verified tokens cache disabled and enabled: the
+    profile scenario reuses its token, refresh gets a new token on every request (a single decode).
+    """
+    from .tokens.token import token_cache
+
+    app, db = build_app()
+    runner = Runner(app, db, seed(db, users, devices=1, emails=1, passwords=1, resets=0))
+
+    results = {}
+    for mode, size in (('uncached', 0), ('cached', app.config.get('TOKEN_CACHE_SIZE', 10000))):
+        token_cache.configure(size, app.config.get('TOKEN_CACHE_EXPIRED_GRACE', app.config['TOKEN_TIMEOUT']))
+        token_cache.clear()
+        results[mode] = {name: run_scenario(runner, name, requests) for name in ('profile', 'refresh')}
+        results[mode]['token_cache'] = token_cache.stats()
+
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'users': users,
+        },
+        'results': results,
+    }
+
+
+class MockCursor:
+    """Cursor of listing-like documents created one at a time, as pymongo fetches the batches"""
+    def __init__(self, documents, emails=5):
+        self.remaining = documents
+        self.emails = emails
+        self.timestamp = datetime.now(timezone.utc)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.remaining <= 0:
+            raise StopIteration
+        self.remaining -= 1
+
+        return {
+            '_id': ObjectId(),
+            'full_name': 'User %d' % self.remaining,
+            'emails': [{
+                'email': 'user%d.%d@bench.test' % (self.remaining, position),
+                'verified': False,
+                'current': position == self.emails - 1,
+                'insertedAt': self.timestamp,
+            } for position in range(self.emails)],
+            'insertedAt': self.timestamp,
+        }
+
+
+def compare_streaming(documents=100000):
+    """
+    Peak memory (tracemalloc) and time of a response holding a large cursor: loaded and encoded at once,
+    against streamed by output_json (Streamed body). No resource returns cursors since the keyset
+    pagination, this is the only caller of the streaming path.
+    """
+    from .common import output_json, serializer, Streamed
+
+    app = create_app('testing')
+    modes = {
+        'loaded': lambda: [serializer.dumps({'success': True, 'users': list(MockCursor(documents))})],
+        'streamed': lambda: output_json(Streamed({'success': True, 'users': MockCursor(documents)}), 200).response,
+    }
+
+    results = {}
+    for name, respond in modes.items():
+        with app.test_request_context():
+            tracemalloc.start()
+            started = time.perf_counter()
+            size = sum(len(chunk) for chunk in respond())
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        results[name] = {
+            'seconds': elapsed,
+            'peak_mb': peak / (1024 * 1024),
+            'bytes': size,
+        }
+
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'documents': documents,
+            'encoder': serializer.name,
+        },
+        'results': results,
+    }
+
+
+def _previous_password_change(hasher, passwords, current_password, password, timestamp):
+    # the password change replaced by PasswordHistory: current password, reuse and current flag checks
+    if not any(hasher.check(item.get('password'), current_password) and item.get('current') for item in passwords):
+        return False
+
+    if not any(hasher.check(item.get('password'), password) for item in passwords):
+        passwords.append({'current': True, 'password': hasher.generate(password), 'insertedAt': timestamp})
+
+    for item in passwords:
+        is_current = hasher.check(item.get('password'), password)
+        if is_current != item.get('current'):
+            item.update({'updatedAt': timestamp})
+        item.update({'current': is_current})
+
+    return True
+
+
+def _password_change(hasher, passwords, current_password, password, timestamp):
+    from .users.passwords import PasswordHistory
+
+    history = PasswordHistory(passwords)
+    if not history.verify_current(current_password):
+        return False
+
+    history.use(password, timestamp)
+    return True
+
+
+def compare_password_history(histories=(10, 50, 200), repeat=3, method='pbkdf2:sha256:10000'):
+    """
+    Time and hashes computed by a password change for users with long password histories, to a new
+    password and to the oldest one: the previous flow (every hash checked up to three times) against
+    PasswordHistory. Hashes use `method` (cheaper than the default), the ratio is what matters.
+    """
+    from . import hasher
+
+    create_app('testing')
+    timestamp = datetime.now(timezone.utc)
+    stored = [generate_password_hash('password-%d' % index, method) for index in range(max(histories))]
+
+    results = {}
+    for length in histories:
+        passwords = [{'current': index == length - 1, 'password': stored[index], 'insertedAt': timestamp}
+                     for index in range(length)]
+        cases = {'new': 'password-new', 'reused': 'password-0'}
+
+        results[length] = {}
+        for case, password in cases.items():
+            results[length][case] = {}
+            for name, change in (('previous', _previous_password_change), ('history', _password_change)):
+                elapsed = 0.0
+                hashes = hasher.submitted
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    changed = change(hasher, [dict(item) for item in passwords], 'password-%d' % (length - 1),
+                                     password, timestamp)
+                    elapsed += time.perf_counter() - started
+                    if not changed:
+                        raise RuntimeError('The current password was not verified')
+
+                results[length][case][name] = {
+                    'mean_ms': 1000 * elapsed / repeat,
+                    'hashes': (hasher.submitted - hashes) // repeat,
+                }
+
+    return {
+        'meta': {
+            'date': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'python': platform.python_version(),
+            'method': method,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
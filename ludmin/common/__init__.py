@@ -1,4 +1,11 @@
-from .output_json import output_json
+from .output_json import output_json, Streamed
 from .slugify import slugify
+from .pagination import page_args, offset_args, keyset_page, keyset_stream, InvalidCursor
+from .hashing import Hasher, HashingUnavailable
+from .metrics import metrics
+from .limits import limiter, RateLimited
+from .serializer import serializer
+from .schema import Schema, Field, InvalidParameters, json_body
 
-__all__ = [output_json, slugify]
+__all__ = [output_json, Streamed, slugify, page_args, offset_args, keyset_page, keyset_stream, InvalidCursor, Hasher,
+           HashingUnavailable, metrics, limiter, RateLimited, serializer, Schema, Field, InvalidParameters, json_body]
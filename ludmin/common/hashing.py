@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from .metrics import metrics
+
+
+class HashingUnavailable(ServiceUnavailable):
+    """The hashing pool is saturated or did not answer in time"""
+    data = {'error': 'Service busy, try again later.'}
+
+
+class Hasher:
+    """
+    Password hashing and verification on a bounded process pool, so PBKDF2 does not hold the GIL
+    of the request threads. Requests beyond the pool size plus the queue depth are rejected with a 503.
+    """
+    def __init__(self, app=None):
+        self.pool_size = 0
+        self.queue_depth = 0
+        self.timeout = None
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.shutdown()
+        self.pool_size = app.config.get('HASH_POOL_SIZE', os.cpu_count() or 1)
+        self.queue_depth = app.config.get('HASH_QUEUE_DEPTH', self.pool_size * 4)
+        self.timeout = app.config.get('HASH_TIMEOUT', 10)
+        self._slots = threading.BoundedSemaphore(self.pool_size + self.queue_depth) if self.pool_size else None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _pool(self):
+        # created on first use, and again in a forked child (pools can not be shared between processes)
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+                self._pid = os.getpid()
+
+            return self._executor
+
+    def _record(self, started):
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.completed += 1
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+
+    def _done(self, future):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def _run(self, function, *args):
+        started = time.monotonic()
+
+        # no pool configured, hash on the request thread
+        if not self.pool_size:
+            with self._lock:
+                self.submitted += 1
+            try:
+                return function(*args)
+            finally:
+                self._record(started)
+
+        # bounded: running + queued jobs, a slot is released only when its job is really done
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashingUnavailable()
+
+        try:
+            future = self._pool().submit(function, *args)
+        except Exception:
+            self._slots.release()
+            self.shutdown()
+            raise HashingUnavailable()
+
+        with self._lock:
+            self.submitted += 1
+            self.in_flight += 1
+        future.add_done_callback(self._done)
+
+        try:
+            result = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            self.timeouts += 1
+            raise HashingUnavailable()
+
+        self._record(started)
+        return result
+
+    def generate(self, password):
+        with metrics.phase('hash'):
+            return self._run(generate_password_hash, password)
+
+    def check(self, pwhash, password):
+        with metrics.phase('hash'):
+            return self._run(check_password_hash, pwhash, password)
+
+    def stats(self):
+        return {
+            'pool_size': self.pool_size,
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'latency_avg_ms': 1000 * self.latency_total / self.completed if self.completed else 0.0,
+            'latency_max_ms': 1000 * self.latency_max,
+        }
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=wait)
+            self._executor = None
+            self._pid = None
@@ -0,0 +1,150 @@
+import functools
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from werkzeug.exceptions import TooManyRequests
+
+from .schema import json_body
+from .shared_table import SharedTable
+
+
+class RateLimited(TooManyRequests):
+    """The request was rejected by the admission control, before doing any work"""
+    data = {'error': 'Too many requests, try again later.'}
+
+    def __init__(self, retry_after=1):
+        super().__init__()
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+    def get_headers(self, environ=None):
+        return super().get_headers(environ) + [('Retry-After', str(self.retry_after))]
+
+
+def _request_keys():
+    """Values the buckets are keyed by, for the current request (None when not available)"""
+    body = json_body()
+    email = body.get('email') if isinstance(body, dict) else None
+    return {
+        'ip': request.remote_addr,
+        'device_id': g.token.decoded.get('device_id') if g.get('token') else None,
+        # emails are case insensitive
+        'email': email.strip().lower() if isinstance(email, str) else None,
+    }
+
+
+class Limiter:
+    """
+    Admission control for the expensive endpoints: a max of concurrent requests per endpoint and
+    process (CONCURRENCY_LIMITS) and token buckets per endpoint and client ip, device id or email
+    (RATE_LIMITS, as (requests, per seconds)). Buckets live in a LRU of LIMITER_SIZE entries, or with
+    LIMITER_FILE in a memory mapped file shared by every worker of the host.
+    """
+    def __init__(self):
+        self.rates = {}
+        self.max_size = 100000
+        self._slots = {}
+        self._buckets = OrderedDict()
+        self._shared = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def init_app(self, app):
+        self.rates = app.config.get('RATE_LIMITS', {})
+        self.max_size = app.config.get('LIMITER_SIZE', 100000)
+        shared_file = app.config.get('LIMITER_FILE')
+        self._shared = SharedTable(shared_file, self.max_size) if shared_file else None
+        self._slots = {name: threading.BoundedSemaphore(size)
+                       for name, size in app.config.get('CONCURRENCY_LIMITS', {}).items() if size}
+        with self._lock:
+            self._buckets.clear()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.admitted = 0
+        self.rate_limited = 0
+        self.concurrency_limited = 0
+
+    def _consume(self, key, capacity, per):
+        """Take a token from the key's bucket, returns the seconds until one is available (0 when taken)"""
+        now = time.time()
+        wait = []
+
+        def take(entry):
+            # bucket as (tokens, timestamp), refilled for the time elapsed since the last request
+            tokens, stamp = entry if entry is not None else (capacity, now)
+            tokens = min(capacity, tokens + (now - stamp) * capacity / per)
+            wait.append(0 if tokens >= 1 else (1 - tokens) * per / capacity)
+            return (tokens - 1 if tokens >= 1 else tokens), now
+
+        if self._shared is not None:
+            self._shared.update(key, take)
+        else:
+            with self._lock:
+                self._buckets[key] = take(self._buckets.get(key))
+                self._buckets.move_to_end(key)
+                while len(self._buckets) > self.max_size:
+                    self._buckets.popitem(last=False)
+
+        return wait[0]
+
+    def admit(self, name, keys):
+        """
+        Take a token from the endpoint's bucket of every key (ip, device_id, email), raises RateLimited
+        when one of them is empty
+        """
+        for key_type, (capacity, per) in self.rates.get(name, {}).items():
+            value = keys.get(key_type)
+            if value is None:
+                continue
+
+            wait = self._consume('%s:%s:%s' % (name, key_type, value), capacity, per)
+            if wait:
+                with self._lock:
+                    self.rate_limited += 1
+                raise RateLimited(wait)
+
+    def acquire(self, name):
+        """Take one of the endpoint's concurrency slots (release it when done), raises RateLimited if none left"""
+        slots = self._slots.get(name)
+        if slots is not None and not slots.acquire(blocking=False):
+            with self._lock:
+                self.concurrency_limited += 1
+            raise RateLimited()
+
+        with self._lock:
+            self.admitted += 1
+
+    def release(self, name):
+        slots = self._slots.get(name)
+        if slots is not None:
+            slots.release()
+
+    def limit(self, name):
+        """Decorator for a resource method, the request is rejected with a 429 before it runs"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                self.admit(name, _request_keys())
+                self.acquire(name)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.release(name)
+
+            return wrapper
+
+        return decorator
+
+    def stats(self):
+        return {
+            'shared': self._shared is not None,
+            'buckets': len(self._buckets) if self._shared is None else None,
+            'admitted': self.admitted,
+            'rate_limited': self.rate_limited,
+            'concurrency_limited': self.concurrency_limited,
+        }
+
+
+limiter = Limiter()
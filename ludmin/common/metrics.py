@@ -0,0 +1,141 @@
+import threading
+import time
+from bisect import bisect_left
+from flask import request
+
+# latency buckets (seconds)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)      # last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+# phases of the request being served by the thread, a thread local is much cheaper to reach than g
+# (the phases are timed several times per request)
+_current = threading.local()
+
+
+def _phases():
+    return getattr(_current, 'phases', None)
+
+
+class _Phase:
+    """Adds the time spent in the block to the current request's phase"""
+    __slots__ = ('name', 'phases', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.phases = _phases()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.phases is not None:
+            self.phases[self.name] = self.phases.get(self.name, 0.0) + time.perf_counter() - self.started
+        return False
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Per endpoint latency histograms, broken down by phase (jwt, mongo, hash, serialize and the rest
+    as other), and status codes counters. Rendered in the Prometheus text format.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._latency = {}
+        self._statuses = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config.get('METRICS_ENABLED', True)
+        with self._lock:
+            self._latency = {}
+            self._statuses = {}
+
+    def add_stats(self, name, function):
+        """Expose the numeric values of a stats() dictionary as gauges"""
+        self._stats[name] = function
+
+    @staticmethod
+    def phase(name):
+        return _Phase(name)
+
+    def start_request(self):
+        if self.enabled:
+            _current.phases = {}
+            _current.started = time.perf_counter()
+
+    def finish_request(self, response):
+        phases = _phases()
+        if phases is None:
+            return
+
+        elapsed = time.perf_counter() - _current.started
+        _current.phases = None
+        endpoint = request.endpoint or 'unknown'
+        other = max(0.0, elapsed - sum(phases.values()))
+
+        with self._lock:
+            self._observe(endpoint, 'total', elapsed)
+            self._observe(endpoint, 'other', other)
+            for name, value in phases.items():
+                self._observe(endpoint, name, value)
+
+            key = (endpoint, request.method, response.status_code)
+            self._statuses[key] = self._statuses.get(key, 0) + 1
+
+    def _observe(self, endpoint, phase, value):
+        histogram = self._latency.get((endpoint, phase))
+        if histogram is None:
+            histogram = self._latency[(endpoint, phase)] = Histogram()
+        histogram.observe(value)
+
+    def render(self):
+        lines = [
+            '# HELP ludmin_request_duration_seconds Request latency by endpoint and phase.',
+            '# TYPE ludmin_request_duration_seconds histogram',
+        ]
+        with self._lock:
+            latency = sorted(self._latency.items())
+            statuses = sorted(self._statuses.items())
+            for (endpoint, phase), histogram in latency:
+                labels = 'endpoint="%s",phase="%s"' % (_label(endpoint), _label(phase))
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('ludmin_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+                lines.append('ludmin_request_duration_seconds_sum{%s} %f' % (labels, histogram.total))
+                lines.append('ludmin_request_duration_seconds_count{%s} %d' % (labels, histogram.count))
+
+        lines.append('# HELP ludmin_requests_total Responses by endpoint, method and status code.')
+        lines.append('# TYPE ludmin_requests_total counter')
+        for (endpoint, method, status), count in statuses:
+            lines.append('ludmin_requests_total{endpoint="%s",method="%s",status="%s"} %d' % (
+                _label(endpoint), method, status, count))
+
+        for name, function in sorted(self._stats.items()):
+            lines.append('# TYPE ludmin_%s gauge' % name)
+            for stat, value in sorted(function().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('ludmin_%s{stat="%s"} %s' % (name, _label(stat), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -1,14 +1,92 @@
-from flask import make_response
-from bson.json_util import dumps
+from collections.abc import Iterator
+from flask import current_app, make_response, stream_with_context
+
+from .metrics import metrics
+from .serializer import serializer
+
+# streamed responses are sent in chunks of about this size (characters)
+CHUNK_SIZE = 64 * 1024
+
+
+class Streamed:
+    """
+    Response body to stream (opt-in): the cursors and generators it holds are encoded one item at a time.
+    Other responses are encoded at once, without looking for cursors in them.
+    """
+    def __init__(self, body):
+        self.body = body
+
+
+def _is_streamable(obj):
+    """Cursors (pymongo or any other) and generators, values that should not be loaded at once"""
+    return isinstance(obj, Iterator)
+
+
+def _has_stream(obj):
+    if _is_streamable(obj):
+        return True
+    if isinstance(obj, dict):
+        return any(_has_stream(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_stream(value) for value in obj)
+    return False
+
+
+def iter_json(obj):
+    """
+    Encode an object as JSON pieces, cursors and generators are consumed one item at a time
+    so the whole result is never held in memory. Other values use the configured encoder.
+    """
+    if isinstance(obj, dict) and _has_stream(obj):
+        yield '{'
+        for index, (key, value) in enumerate(obj.items()):
+            yield ('' if index == 0 else ', ') + serializer.dumps(str(key)) + ': '
+            yield from iter_json(value)
+        yield '}'
+
+    elif _is_streamable(obj) or (isinstance(obj, (list, tuple)) and _has_stream(obj)):
+        yield '['
+        for index, item in enumerate(obj):
+            if index:
+                yield ', '
+            yield from iter_json(item)
+        yield ']'
+
+    else:
+        yield serializer.dumps(obj)
+
+
+def _chunked(pieces, size=CHUNK_SIZE):
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+
+    if buffer:
+        yield ''.join(buffer)
 
 
 # http://blog.alienretro.com/using-mongodb-with-flask-restful/
 def output_json(obj, code, headers=None):
     """
     This is needed because we need to use a custom JSON converter
-    that knows how to translate MongoDB types to JSON.
+    that knows how to translate MongoDB types to JSON (see serializer).
+    Streamed responses are sent in chunks.
     """
-    resp = make_response(dumps(obj), code)
+    if isinstance(obj, Streamed):
+        resp = current_app.response_class(
+            stream_with_context(_chunked(iter_json(obj.body))), status=code, mimetype='application/json'
+        )
+    else:
+        with metrics.phase('serialize'):
+            body = serializer.dumps(obj)
+        resp = make_response(body, code)
+
     resp.headers.extend(headers or {})
 
     return resp
@@ -0,0 +1,103 @@
+from flask import Response, current_app, request, stream_with_context
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from .schema import Schema, Field
+from .serializer import serializer
+
+NDJSON = 'application/x-ndjson'
+
+PAGE = Schema(
+    Field('limit', int, location='args'),
+    Field('after', location='args'),
+    Field('format', location='args'),
+)
+
+OFFSET_PAGE = Schema(
+    Field('limit', int, location='args'),
+    Field('offset', int, location='args'),
+)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _page_size(limit):
+    limit = limit or current_app.config.get('PAGE_SIZE', 100)
+    return max(1, min(limit, current_app.config.get('PAGE_SIZE_MAX', 1000)))
+
+
+def page_args():
+    """Read limit/after/format from the query string, limit is capped by PAGE_SIZE_MAX"""
+    data = PAGE.parse()
+
+    limit = _page_size(data.get('limit'))
+
+    after = None
+    if data.get('after'):
+        try:
+            after = ObjectId(data.get('after'))
+        except (InvalidId, TypeError):
+            raise InvalidCursor('Invalid after cursor.')
+
+    # streaming is opt-in by format=ndjson or an Accept header asking for it
+    stream = data.get('format') == 'ndjson' or request.accept_mimetypes.best == NDJSON
+
+    return {
+        'limit': limit,
+        'stream_limit': limit if data.get('limit') else None,    # streams are not paged unless limited
+        'after': after,
+        'stream': stream,
+    }
+
+
+def offset_args():
+    """Read limit/offset from the query string, for the per user lists not ordered by _id"""
+    data = OFFSET_PAGE.parse()
+    return {'limit': _page_size(data.get('limit')), 'offset': max(0, data.get('offset') or 0)}
+
+
+def _keyset_find(collection, query, projection, after):
+    # the _id is always read to build the cursor, hidden afterwards if the projection excluded it
+    hide_id = projection is not None and projection.get('_id') == 0
+    if hide_id:
+        projection = {field: value for field, value in projection.items() if field != '_id'} or None
+
+    if after:
+        query = dict(query, _id={'$gt': after})
+
+    return collection.find(query, projection).sort('_id', 1), hide_id
+
+
+def keyset_page(collection, query, projection, limit, after=None):
+    """One page of documents ordered by _id and the cursor to the next page (None on the last page)"""
+    cursor, hide_id = _keyset_find(collection, query, projection, after)
+
+    # read one extra document to know if there is a next page
+    documents = list(cursor.limit(limit + 1))
+    next_after = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_after = str(documents[-1].get('_id'))
+
+    if hide_id:
+        for document in documents:
+            document.pop('_id', None)
+
+    return documents, next_after
+
+
+def keyset_stream(collection, query, projection, limit=None, after=None):
+    """Stream the documents ordered by _id as NDJSON, one document per line"""
+    cursor, hide_id = _keyset_find(collection, query, projection, after)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    def generate():
+        for document in cursor.batch_size(current_app.config.get('PAGE_SIZE', 100)):
+            if hide_id:
+                document.pop('_id', None)
+            yield serializer.dumps(document) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
@@ -0,0 +1,99 @@
+"""
+Declarative request schemas, declared once at import time (replaces building a reqparse parser on
+every request). Every invalid field is reported in a single 400 response.
+"""
+from flask import request
+from werkzeug.exceptions import BadRequest
+
+MESSAGES = {
+    'json': 'Missing required parameter in the JSON body',
+    'args': 'Missing required parameter in the query string',
+}
+
+
+class InvalidParameters(BadRequest):
+    """The request's parameters do not match the schema, rendered as {'error', 'message': {name: error}}"""
+    def __init__(self, errors):
+        super().__init__()
+        self.data = {'error': 'Invalid parameters.', 'message': errors}
+
+
+def json_body():
+    """The request's JSON body (None when missing or not valid JSON), parsed once per request"""
+    return request.get_json(silent=True)
+
+
+def _string(value):
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise ValueError('Must be a string')
+    return str(value)
+
+
+def _integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Must be an integer')
+
+
+def _of_type(expected, description):
+    def convert(value):
+        if not isinstance(value, expected):
+            raise ValueError('Must be %s' % description)
+        return value
+    return convert
+
+
+# converters by declared type, values of other types are passed to the type itself
+CONVERTERS = {
+    str: _string,
+    int: _integer,
+    list: _of_type(list, 'a list'),
+    dict: _of_type(dict, 'an object'),
+}
+
+
+class Field:
+    def __init__(self, name, type=str, required=False, location='json'):
+        self.name = name
+        self.convert = CONVERTERS.get(type, type)
+        self.required = required
+        self.location = location
+
+
+class Schema:
+    """Fields read from the JSON body (location='json', default) or the query string (location='args')"""
+    def __init__(self, *fields):
+        # (name, convert, required, location) tuples, the fields are not looked up per request
+        self.fields = tuple((field.name, field.convert, field.required, field.location) for field in fields)
+        self.uses_args = any(field.location == 'args' for field in fields)
+
+    def load(self, body, args=None):
+        """(values, errors) of a decoded body and query string, missing optional fields are None"""
+        if not isinstance(body, dict):
+            body = {}
+
+        values = {}
+        errors = {}
+        for name, convert, required, location in self.fields:
+            value = body.get(name) if location == 'json' else (args or {}).get(name)
+            if value is None:
+                if required:
+                    errors[name] = MESSAGES[location]
+                values[name] = None
+                continue
+
+            try:
+                values[name] = convert(value)
+            except ValueError as e:
+                errors[name] = str(e)
+
+        return values, errors
+
+    def parse(self):
+        """Values of the current request, raises InvalidParameters (400) with every invalid field"""
+        values, errors = self.load(json_body(), request.args if self.uses_args else None)
+        if errors:
+            raise InvalidParameters(errors)
+
+        return values
@@ -0,0 +1,84 @@
+import json
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId, json_util
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+def bson_default(obj):
+    """
+    BSON values as Mongo extended JSON, same output as bson.json_util.dumps
+    ({"$oid": ...}, {"$date": milliseconds}, ...)
+    """
+    if isinstance(obj, ObjectId):
+        return {'$oid': str(obj)}
+    if isinstance(obj, datetime):
+        # naive datetimes are UTC (as read from Mongo without tz_aware)
+        return {'$date': ((obj if obj.tzinfo else obj.replace(tzinfo=timezone.utc)) - EPOCH) // MILLISECOND}
+    return json_util.default(obj)
+
+
+def _orjson_dumps(obj):
+    # datetimes go through the hook, orjson would write them as RFC 3339 strings
+    return orjson.dumps(
+        obj, default=bson_default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    ).decode('utf-8')
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, default=bson_default, escape_forward_slashes=False)
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=bson_default)
+
+
+# available encoders by name, in order of preference
+ENCODERS = {
+    'orjson': _orjson_dumps if orjson else None,
+    'ujson': _ujson_dumps if ujson else None,
+    'stdlib': _stdlib_dumps,
+    # previous encoder, converts the whole object in python before encoding it
+    'bson': json_util.dumps,
+}
+
+
+class Serializer:
+    """
+    JSON encoder of the API responses, JSON_ENCODER selects it: 'auto' (orjson or ujson when installed,
+    optional: pip3 install orjson, else the standard library), 'orjson', 'ujson', 'stdlib' or 'bson'.
+    BSON values are written as Mongo extended JSON whatever the encoder.
+    """
+    def __init__(self):
+        self.name = 'stdlib'
+        self.dumps = _stdlib_dumps
+
+    def init_app(self, app):
+        self.name, self.dumps = self.select(app.config.get('JSON_ENCODER', 'auto'))
+
+    @staticmethod
+    def select(name):
+        """(name, dumps) of the encoder, raises ValueError when unknown or not installed"""
+        if name == 'auto':
+            name = next(name for name, dumps in ENCODERS.items() if dumps is not None)
+
+        if ENCODERS.get(name) is None:
+            raise ValueError('JSON encoder %r is not available (%s)' % (
+                name, ', '.join(['auto'] + [name for name, dumps in ENCODERS.items() if dumps is not None])
+            ))
+
+        return name, ENCODERS[name]
+
+
+serializer = Serializer()
@@ -0,0 +1,83 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+# slot layout: key hash (0 marks an empty slot), value, timestamp
+SLOT = struct.Struct('<Qdd')
+
+
+class SharedTable:
+    """
+    Fixed size hash table on a memory mapped file, shared by every process mapping the same file.
+    Direct mapped: a key landing on a slot used by another key replaces it (acts as the eviction).
+    Reads and writes hold a file lock, so values are never seen half written.
+    """
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # opened again after a fork: file locks are shared by the descriptors a child inherits
+        if self._pid != os.getpid():
+            size = self.slots * SLOT.size
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _hash(key):
+        hashed = int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+        return hashed or 1
+
+    def _offset(self, hashed):
+        return (hashed % self.slots) * SLOT.size
+
+    def _read(self, hashed):
+        stored, value, stamp = SLOT.unpack_from(self._map, self._offset(hashed))
+        return (value, stamp) if stored == hashed else None
+
+    def get(self, key):
+        """(value, timestamp) stored for the key, None when not stored"""
+        hashed = self._hash(key)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                return self._read(hashed)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def update(self, key, function):
+        """
+        Atomically replace the key's (value, timestamp) by function(current), current is None when
+        not stored. Returning None from the function removes the key. Returns the new entry.
+        """
+        hashed = self._hash(key)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                entry = function(self._read(hashed))
+                if entry is None:
+                    if self._read(hashed) is not None:
+                        SLOT.pack_into(self._map, self._offset(hashed), 0, 0.0, 0.0)
+                else:
+                    SLOT.pack_into(self._map, self._offset(hashed), hashed, entry[0], entry[1])
+                return entry
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def set(self, key, value, timestamp):
+        self.update(key, lambda current: (value, timestamp))
+
+    def delete(self, key):
+        self.update(key, lambda current: None)
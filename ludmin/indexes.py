@@ -0,0 +1,75 @@
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
+
+
+# indexes required by the API queries, per collection: (keys, options)
+INDEXES = {
+    'users': [
+        # login and reset: {current_email} (normalized), unique
+        ([('current_email', ASCENDING)],
+         {'name': 'current_email', 'unique': True, 'sparse': True}),
+        # signup and email changes: {all_emails}, every email ever used by an user belongs to it only
+        ([('all_emails', ASCENDING)],
+         {'name': 'all_emails', 'unique': True, 'sparse': True}),
+    ],
+    'sessions': [
+        # one session per user and device: login, refresh, logout and the user's devices
+        ([('user_id', ASCENDING), ('device_id', ASCENDING)],
+         {'name': 'user_id_device_id', 'unique': True}),
+        # the user's devices by last use (device_id breaks the ties), the pages are not sorted in memory
+        ([('user_id', ASCENDING), ('lastUsed', DESCENDING), ('device_id', ASCENDING)],
+         {'name': 'user_id_lastUsed_device_id'}),
+        # idle devices cleanup: {lastUsed: {$lt}} (BSON date)
+        ([('lastUsed', ASCENDING)],
+         {'name': 'lastUsed'}),
+    ],
+    'reset_requests': [
+        # reset password: {email, enabled, failures: {$lt}, expiresAt: {$gt}}
+        ([('email', ASCENDING), ('enabled', ASCENDING), ('failures', ASCENDING)],
+         {'name': 'email_enabled_failures'}),
+        # requests are removed once expired (expiresAt is a BSON date)
+        ([('expiresAt', ASCENDING)],
+         {'name': 'expiresAt_ttl', 'expireAfterSeconds': 0}),
+    ],
+}
+
+
+def _normalize_keys(keys):
+    return [(field, int(direction) if isinstance(direction, (int, float)) else direction)
+            for field, direction in keys]
+
+
+def ensure_indexes(db):
+    """Create the expected indexes (no-op for the ones already built), returns (collection, name) tuples"""
+    created = []
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            created.append((collection, db[collection].create_index(keys, **options)))
+
+    return created
+
+
+def missing_indexes(db):
+    """Expected indexes not present in the database, as (collection, keys, options) tuples"""
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = [_normalize_keys(info.get('key')) for info in db[collection].index_information().values()]
+        for keys, options in indexes:
+            if _normalize_keys(keys) not in existing:
+                missing.append((collection, keys, options))
+
+    return missing
+
+
+def check_indexes(app, db):
+    """Log a warning for every expected index not built yet"""
+    try:
+        missing = missing_indexes(db)
+    except PyMongoError as e:
+        app.logger.warning('Unable to check indexes: %s', e)
+        return
+
+    for collection, keys, options in missing:
+        app.logger.warning(
+            'Missing index %s on %s %s, run "manage.py ensure_indexes"', options.get('name'), collection, keys
+        )
@@ -0,0 +1,207 @@
+import json
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from pymongo import monitoring
+
+from .indexes import INDEXES
+
+# connection handshake, auth and housekeeping commands, not issued by the API queries
+IGNORED_COMMANDS = {'ismaster', 'isMaster', 'ping', 'buildinfo', 'buildInfo', 'getnonce', 'authenticate',
+                    'saslStart', 'saslContinue', 'endSessions', 'killCursors', 'getLastError'}
+
+Query = namedtuple('Query', 'endpoint collection operation shape duration_ms indexed failed')
+
+
+def query_shape(value):
+    """The filter with its values replaced by 1 ($and/$or clauses are kept), same shape for the same query"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)) and value and all(isinstance(item, dict) for item in value):
+        return [query_shape(item) for item in value]
+    return 1
+
+
+def _command_filter(name, command):
+    if name == 'find':
+        return command.get('filter') or {}
+    if name in ('count', 'distinct', 'findAndModify'):
+        return command.get('query') or {}
+    if name == 'update':
+        return (command.get('updates') or [{}])[0].get('q') or {}
+    if name == 'delete':
+        return (command.get('deletes') or [{}])[0].get('q') or {}
+    if name == 'aggregate':
+        stages = command.get('pipeline') or [{}]
+        return stages[0].get('$match') or {}
+    return None
+
+
+def filter_paths(query, prefix=''):
+    """Fields used by a filter as dotted paths, $elemMatch conditions are paths of the array field"""
+    paths = set()
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            for clause in value:
+                paths |= filter_paths(clause, prefix)
+        elif key == '$elemMatch' and isinstance(value, dict):
+            paths |= filter_paths(value, prefix)
+        elif not key.startswith('$'):
+            paths.add(prefix + key)
+            if isinstance(value, dict):
+                paths |= filter_paths(value, prefix + key + '.')
+
+    return paths
+
+
+def is_indexed(collection, query):
+    """A filter can use an index when it includes the first field of one (_id included)"""
+    paths = filter_paths(query)
+    if not paths:
+        return True
+
+    leading = {'_id'} | {keys[0][0] for keys, options in INDEXES.get(collection, [])}
+    return bool(paths & leading)
+
+
+class QueryCapture(list):
+    """Queries recorded while capturing"""
+    def for_endpoint(self, endpoint):
+        return [query for query in self if query.endpoint == endpoint]
+
+    def unindexed(self):
+        return [query for query in self if not query.indexed]
+
+
+class QueryLog(monitoring.CommandListener):
+    """
+    pymongo command listener: every command is recorded with its duration, collection, operation and
+    filter shape for the Flask endpoint that issued it (None from background threads). Commands slower
+    than SLOW_QUERY_MS, filters not covered by INDEXES and requests issuing more than QUERY_BUDGET
+    commands are logged. Registered once per process, before the Mongo client is created.
+    """
+    def __init__(self):
+        self.slow_ms = 100
+        self.budget = None
+        self.logger = None
+        self._registered = False
+        self._pending = {}
+        self._captures = []
+        self._warned_shapes = set()
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def init_app(self, app):
+        self.slow_ms = app.config.get('SLOW_QUERY_MS', 100)
+        self.budget = app.config.get('QUERY_BUDGET')
+        self.logger = app.logger
+        self._warned_shapes = set()
+        self._reset_stats()
+
+        # only clients created after the registration notify the listener
+        if not self._registered:
+            monitoring.register(self)
+            self._registered = True
+
+    def _reset_stats(self):
+        self.commands = 0
+        self.slow = 0
+        self.failed = 0
+        self.unindexed = 0
+        self.over_budget = 0
+
+    def started(self, event):
+        name = event.command_name
+        if name in IGNORED_COMMANDS:
+            return
+
+        command = event.command
+        collection = command.get(name) if name != 'getMore' else command.get('collection')
+        query = _command_filter(name, command)
+        self._pending[event.request_id] = (
+            request.endpoint if has_request_context() else None,
+            collection if isinstance(collection, str) else None,
+            name,
+            json.dumps(query_shape(query), sort_keys=True) if query is not None else None,
+            is_indexed(collection, query) if query is not None else True,
+        )
+
+    def succeeded(self, event):
+        self._record(event, False)
+
+    def failed(self, event):
+        self._record(event, True)
+
+    def _record(self, event, failed):
+        pending = self._pending.pop(event.request_id, None)
+        if pending is None:
+            return
+
+        endpoint, collection, operation, shape, indexed = pending
+        query = Query(endpoint, collection, operation, shape, event.duration_micros / 1000.0, indexed, failed)
+
+        with self._lock:
+            self.commands += 1
+            self.failed += failed
+            self.slow += query.duration_ms >= self.slow_ms
+            self.unindexed += not query.indexed
+            warn_shape = not query.indexed and (query.collection, query.shape) not in self._warned_shapes
+            if warn_shape:
+                self._warned_shapes.add((query.collection, query.shape))
+            for capture in self._captures:
+                capture.append(query)
+
+        if has_request_context():
+            g.setdefault('queries', []).append(query)
+
+        if self.logger is None:
+            return
+        if query.duration_ms >= self.slow_ms:
+            self.logger.warning('Slow query (%.1fms) from %s: %s %s %s', query.duration_ms, query.endpoint,
+                                query.operation, query.collection, query.shape)
+        if warn_shape:
+            self.logger.warning('Unindexed query from %s: %s %s %s', query.endpoint, query.operation,
+                                query.collection, query.shape)
+
+    def queries(self):
+        """Commands issued so far by the current request"""
+        return g.get('queries', []) if has_request_context() else []
+
+    def finish_request(self, response):
+        """Log the request when it went over the commands budget"""
+        if not self.budget:
+            return
+
+        queries = self.queries()
+        if len(queries) > self.budget:
+            with self._lock:
+                self.over_budget += 1
+            if self.logger is not None:
+                self.logger.warning('%s issued %d queries (budget %d): %s', request.endpoint, len(queries),
+                                    self.budget, ', '.join('%s %s' % (query.operation, query.collection)
+                                                           for query in queries))
+
+    @contextmanager
+    def capture(self):
+        """Queries recorded while in the block (from any thread), for assertions"""
+        captured = QueryCapture()
+        with self._lock:
+            self._captures.append(captured)
+        try:
+            yield captured
+        finally:
+            with self._lock:
+                self._captures.remove(captured)
+
+    def stats(self):
+        return {
+            'commands': self.commands,
+            'slow': self.slow,
+            'failed': self.failed,
+            'unindexed': self.unindexed,
+            'over_budget': self.over_budget,
+        }
+
+
+query_log = QueryLog()
@@ -0,0 +1,106 @@
+"""
+Production server: pre-forked gunicorn workers (optional: pip3 install gunicorn), each one builds its own
+app and Mongo client after the fork (pymongo clients are not fork-safe) and warms the connection pool
+before taking requests. On SIGTERM workers stop accepting, drain the in-flight requests (up to the
+graceful timeout), write the buffered lastUsed touches and stop the hashing pool.
+Started with `manage.py serve` or `python3 -m ludmin.serving`, neither creates the app in the master.
+"""
+import argparse
+import os
+import threading
+from pymongo.errors import PyMongoError
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = object
+
+
+def warm_pool(app, connections):
+    """
+    Open up to `connections` pooled sockets with concurrent pings, so the first requests don't pay for them.
+    Returns the errors of the pings that failed.
+    """
+    from . import mongo
+    errors = []
+
+    def ping():
+        try:
+            with app.app_context():
+                mongo.db.command('ping')
+        except PyMongoError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=ping) for _ in range(max(1, connections))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return errors
+
+
+def _worker_exit(server, worker):
+    """The worker is done serving (in-flight requests already drained)"""
+    from . import hasher
+    from .users.touches import touches
+
+    flushed = touches.flush()
+    hasher.shutdown(wait=True)
+    server.log.info('Worker %s stopped, %d lastUsed touches flushed', worker.pid, flushed)
+
+
+class Server(BaseApplication):
+    """gunicorn application running create_app(config_name) in every worker"""
+    def __init__(self, config_name, bind='0.0.0.0:8080', workers=2, threads=4, graceful_timeout=30,
+                 timeout=30, warm_connections=None):
+        if BaseApplication is object:
+            raise RuntimeError('gunicorn is required to serve (pip3 install gunicorn)')
+
+        self.config_name = config_name
+        self.warm_connections = threads if warm_connections is None else warm_connections
+        self.options = {
+            'bind': bind,
+            'workers': workers,
+            'threads': threads,
+            'worker_class': 'gthread' if threads > 1 else 'sync',
+            'graceful_timeout': graceful_timeout,
+            'timeout': timeout,
+            # the app (and its client) must not be created before the fork
+            'preload_app': False,
+            'worker_exit': _worker_exit,
+        }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # runs in the worker, after the fork
+        from . import create_app
+
+        app = create_app(self.config_name)
+        errors = warm_pool(app, self.warm_connections)
+        if errors:
+            app.logger.warning('Unable to warm the Mongo pool of worker %s: %s', os.getpid(), errors[0])
+
+        return app
+
+
+def main(argv=None):
+    """Command line of the production server (LUDMIN_CONFIG defaults to production)"""
+    parser = argparse.ArgumentParser(prog='manage.py serve', description='Production server (pre-forked workers)')
+    parser.add_argument('-b', '--bind', default='0.0.0.0:8080')
+    parser.add_argument('-w', '--workers', type=int, default=(os.cpu_count() or 1) * 2)
+    parser.add_argument('-t', '--threads', type=int, default=4, help='threads per worker')
+    parser.add_argument('--graceful-timeout', type=int, default=30,
+                        help='seconds a stopping worker has to finish its in-flight requests')
+    args = parser.parse_args(argv)
+
+    Server(os.environ.get('LUDMIN_CONFIG', 'production'), args.bind, args.workers, args.threads,
+           args.graceful_timeout).run()
+
+
+if __name__ == '__main__':
+    main()
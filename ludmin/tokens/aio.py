@@ -0,0 +1,282 @@
+"""
+Asyncio serving mode for the /tokens routes (aiohttp + motor, optional: pip3 install aiohttp motor).
+Same URLs, bodies and response shapes as the tokens blueprint, the Mongo waits do not hold a worker.
+"""
+import asyncio
+import os
+import random
+import uuid
+from datetime import datetime, timezone
+from bson import ObjectId
+from flask import Flask
+from pymongo import ReturnDocument
+
+from config import config
+from .resources import PUBLIC, LOGIN
+from .token import Token, token_cache
+from .. import hasher
+from ..common.hashing import HashingUnavailable
+from ..common.limits import limiter, RateLimited
+from ..common.schema import InvalidParameters
+from ..common.serializer import serializer
+from ..users import repository
+from ..users.passwords import PasswordHistory
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+def _timestamp():
+    return datetime.now(timezone.utc)
+
+
+def _response(body, status=200):
+    response = web.json_response(body, status=status, dumps=serializer.dumps)
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE')
+    return response
+
+
+def _object_id(user_id):
+    return user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+
+
+class TokensHandlers:
+    """The token endpoints, with the sessions queries on motor"""
+    def __init__(self, settings, db):
+        self.settings = settings
+        self.db = db
+
+    async def _arguments(self, request, schema):
+        """JSON body values, or the 400 response of the invalid ones (same schemas as the blueprint)"""
+        values, errors = schema.load(await request.json())
+        if errors:
+            return values, _response(InvalidParameters(errors).data, 400)
+        return values, None
+
+    def _token(self, request):
+        return Token(self.settings, request.headers.get('Authorization'))
+
+    async def options(self, request):
+        return _response(None)
+
+    async def public(self, request):
+        """Public token for a device, when not device id provided, generate a random one"""
+        data, error = await self._arguments(request, PUBLIC)
+        if error:
+            return error
+
+        # use given id, else generate one
+        device_id = data.get('device_id')
+        if not device_id or len(device_id) != 32:
+            device_id = uuid.uuid4().hex
+
+        public_token = self._token(request).generate_public(device_id, ['public'])
+        return _response({'success': True, 'device_id': device_id, 'token': public_token.decode('utf-8')})
+
+    async def refresh(self, request):
+        """Refresh a token"""
+        device_id = request.match_info['device_id']
+        token = self._token(request)
+        new_token = False
+        token_type = False
+
+        try:
+            token_to_refresh = token.decode_token_or_fail(verify_exp=False)
+            if device_id == token_to_refresh.get('device_id'):
+                user_id = token_to_refresh.get('_id')
+                token_rev = token_to_refresh.get('rev')
+            else:
+                return _response({'error': 'Inconsistent device id'}, 500)
+
+        except Exception:
+            return _response({'error': 'Invalid Token'}, 500)
+
+        rev = random.randint(0, 9999)
+
+        if user_id and device_id:
+            user_for_device = await self._refresh_session(_object_id(user_id), device_id, token_rev, rev)
+            if user_for_device:
+                token_type = 'Refresh'
+                new_token = token.generate_logged(user_for_device, device_id, ['basics', 'master'], rev)
+
+        if not new_token:
+            token_type = 'Public'
+            new_token = token.generate_public(device_id, ['public'])
+
+        return _response({'success': True, 'token': new_token.decode('utf-8'), 'type': token_type})
+
+    async def _refresh_session(self, user_id, device_id, token_rev, rev):
+        """The user's profile when the device is still linked with the token's rev (rotated), else None"""
+        # lastUsed goes with the rev, the write is already made
+        session = await self.db.sessions.find_one_and_update({
+            'user_id': user_id,
+            'device_id': device_id,
+            'rev': token_rev,
+            },
+            {'$set': {'rev': rev}, '$max': {'lastUsed': _timestamp()}},
+            projection={'user_id': 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+        if not session:
+            return None
+
+        return await self.db.users.find_one({'_id': user_id}, repository.PUBLIC_PROFILE)
+
+    async def login(self, request):
+        """Login, generates a new token"""
+        token = self._token(request)
+        if not token.has_access('public') and not token.has_access('basics'):
+            return _response({'error': 'Not allowed'}, 401)
+
+        device_id = token.decoded.get('device_id')
+
+        data, error = await self._arguments(request, LOGIN)
+        if error:
+            return error
+
+        try:
+            limiter.admit('login', {
+                'ip': request.remote,
+                'device_id': device_id,
+                # emails are case insensitive, as for the sync login
+                'email': repository.normalize_email(data.get('email')),
+            })
+            limiter.acquire('login')
+        except RateLimited as e:
+            response = _response(e.data, e.code)
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+
+        try:
+            return await self._login(token, device_id, data)
+        finally:
+            limiter.release('login')
+
+    async def _login(self, token, device_id, data):
+        user = await self.db.users.find_one({'current_email': repository.normalize_email(data.get('email'))},
+                                            repository.LOGIN)
+
+        if not user:
+            return _response({'error': 'Incorrect user or password'}, 400)
+
+        # the hash check waits for the hashing pool on a thread, not on the loop
+        verify = PasswordHistory(user.get('passwords')).verify_current
+        try:
+            verified = await asyncio.get_event_loop().run_in_executor(None, verify, data.get('password'))
+        except HashingUnavailable as e:
+            return _response(e.data, e.code)
+
+        if not verified:
+            return _response({'error': 'Incorrect user or password'}, 400)
+
+        rev = random.randint(0, 9999)
+        await self.db.sessions.update_one({
+            'user_id': user.get('_id'), 'device_id': device_id},
+            {'$set': {
+                'rev': rev,
+                'lastUsed': _timestamp(),
+            }, '$setOnInsert': {
+                'description': data.get('description'),
+            }},
+            upsert=True
+        )
+
+        encoded = token.generate_logged(user, device_id, ['basics', 'master'], rev)
+        return _response({'success': True, 'token': encoded.decode('utf-8'), 'type': 'Login'}, 201)
+
+    async def logout(self, request):
+        """Remove the token (logout)"""
+        device_id = request.match_info['device_id']
+        token = self._token(request)
+
+        try:
+            token_to_refresh = token.decode_token_or_fail(verify_exp=False)
+            if device_id != token_to_refresh.get('device_id'):
+                token_to_refresh = token.decode_token_or_fail()
+
+        except Exception:
+            return _response({'error': 'Invalid Token'}, 500)
+
+        if await self._detach(token_to_refresh.get('_id'), device_id):
+            return _response({'success': True})
+
+        return _response({'error': 'Device not linked to user.'})
+
+    async def _detach(self, user_id, device_id):
+        result = await self.db.sessions.delete_one({'user_id': _object_id(user_id), 'device_id': device_id})
+        return result.deleted_count > 0
+
+
+def _global_validations():
+    @web.middleware
+    async def global_validations(request, handler):
+        # check the body is not empty when not using GET/DELETE
+        if request.method not in ('GET', 'DELETE', 'OPTIONS'):
+            try:
+                body = await request.json()
+            except ValueError:
+                body = None
+            if not body:
+                return _response({'error': 'Invalid request.'})
+
+        try:
+            return await handler(request)
+        except web.HTTPNotFound:
+            return _response({'error': 'not found'}, 404)
+        except web.HTTPException:
+            raise
+        except Exception:
+            return _response({'error': 'unexpected'}, 500)
+
+    return global_validations
+
+
+def create_aio_app(config_name=None, db=None):
+    """aiohttp application serving the /tokens routes"""
+    if web is None or (db is None and AsyncIOMotorClient is None):
+        raise RuntimeError('aiohttp and motor are required to serve the tokens asynchronously '
+                           '(pip3 install aiohttp motor)')
+
+    if config_name is None:
+        config_name = os.environ.get('LUDMIN_CONFIG', 'development')
+
+    # a bare Flask app holds the config, the shared extensions are set up from it as by create_app
+    settings = Flask(__name__)
+    settings.config.from_object(config[config_name])
+    hasher.init_app(settings)
+    serializer.init_app(settings)
+    limiter.init_app(settings)
+    token_cache.configure(
+        settings.config.get('TOKEN_CACHE_SIZE', 10000),
+        settings.config.get('TOKEN_CACHE_EXPIRED_GRACE', settings.config['TOKEN_TIMEOUT'])
+    )
+
+    if db is None:
+        # the client is created in the serving process (after any fork)
+        client = AsyncIOMotorClient(settings.config['MONGO_URI'], tz_aware=True)
+        db = client.get_default_database()
+
+    handlers = TokensHandlers(settings.config, db)
+    app = web.Application(middlewares=[_global_validations()])
+    app.router.add_route('POST', '/tokens/public', handlers.public)
+    app.router.add_route('OPTIONS', '/tokens/public', handlers.options)
+    app.router.add_route('POST', '/tokens', handlers.login)
+    app.router.add_route('OPTIONS', '/tokens', handlers.options)
+    app.router.add_route('GET', '/tokens/{device_id}', handlers.refresh)
+    app.router.add_route('DELETE', '/tokens/{device_id}', handlers.logout)
+    app.router.add_route('OPTIONS', '/tokens/{device_id}', handlers.options)
+
+    return app
+
+
+def serve(config_name=None, host='0.0.0.0', port=8081):
+    web.run_app(create_aio_app(config_name), host=host, port=port)
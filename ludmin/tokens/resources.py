@@ -1,18 +1,30 @@
 from flask import Blueprint, g
-from flask_restful import Api, Resource, reqparse
-from flask_pymongo import ObjectId
+from flask_restful import Api, Resource
 from datetime import datetime, timezone
-from werkzeug.security import check_password_hash
 #from flask_restful.utils import cors
 import uuid
 import random
 
-from .. import mongo
+from ..common import output_json, limiter, Schema, Field
+from ..users import repository, sessions
+from ..users.passwords import PasswordHistory
 
 tokens_bp = Blueprint('tokens_api', __name__)
 api = Api(tokens_bp)
+api.representations = {'application/json': output_json}
 #api.decorators = [cors.crossdomain(origin='*', headers=['accept', 'Content-Type', 'Authorization'])]
 
+PUBLIC = Schema(
+    Field('device_id', required=True),
+)
+
+LOGIN = Schema(
+    Field('email', required=True),
+    Field('password', required=True),
+    Field('description', required=True),
+)
+
+
 class PublicTokensResource(Resource):
     def options(self):
         pass
@@ -20,9 +32,7 @@ class PublicTokensResource(Resource):
     def post(self):
         """ Public token for a device, when not device id provided, generate a random one """
 
-        parser = reqparse.RequestParser()
-        parser.add_argument('device_id', required=True)
-        data = parser.parse_args()
+        data = PUBLIC.parse()
         device_id = data.get('device_id')
 
         # use given id, else generate one
@@ -62,32 +72,17 @@ class TokensResource(Resource):
         # random version for this token
         rev = random.randint(0, 9999)
 
-        # if we have a token owner and a device, check if the device still attached to the user
+        # if we have a token owner and a device, rotate the rev if the device still attached to the user
         # we are going to have an user_id only if a logged-in token was provided (despite expired)
         if user_id and device_id:
-            user_for_device = mongo.db.users.find_one({
-                '_id': ObjectId(user_id),
-                'devices': {
-                    '$elemMatch': {
-                        'device_id': device_id,
-                        'rev': token_rev
-                    }
-                }})
-
-            # if this device still attached to the user, issue new token
+            current_date_time = datetime.now(timezone.utc)
+            session = sessions.refresh(
+                user_id, device_id, token_rev, rev, current_date_time
+            )
+
+            # if this device still attached to the user, issue new token (with the current user's name)
+            user_for_device = repository.find_by_id(user_id, repository.PUBLIC_PROFILE) if session else None
             if user_for_device:
-                # update device's lastUsed and rev
-                current_date_time = datetime.now(timezone.utc)
-                mongo.db.users.update({
-                    '_id': user_for_device.get('_id'), 'devices.device_id': device_id},
-                    {'$set': {
-                        'devices.$.lastUsed': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-                        'devices.$.rev': rev,
-                    }},
-                    True
-                )
-
-                # issue fresh token
                 token_type = 'Refresh'
                 new_token = g.token.generate_logged(user_for_device, device_id, ['basics', 'master'], rev)
 
@@ -98,6 +93,7 @@ class TokensResource(Resource):
 
         return {'success': True, 'token': new_token.decode('utf-8'), 'type': token_type}
 
+    @limiter.limit('login')
     def post(self):
         """Login, generates a new token"""
         if not g.token.has_access('public') and not g.token.has_access('basics'):
@@ -106,56 +102,24 @@ class TokensResource(Resource):
         device_id = g.token.decoded.get('device_id')
 
         # validate fields
-        parser = reqparse.RequestParser()
-        parser.add_argument('email', required=True)
-        parser.add_argument('password', required=True)
-        parser.add_argument('description', required=True)
-        data = parser.parse_args()
-
-        # load the user by email
-        user = mongo.db.users.find_one({
-                'emails': {
-                    '$elemMatch': {
-                        'email': data.get('email'),
-                        'current': True
-                    }
-                }
-            })
+        data = LOGIN.parse()
+
+        # load the user by email (only the name and passwords)
+        user = repository.find_by_current_email(data.get('email'), repository.LOGIN)
 
         if not user:
             return {'error': 'Incorrect user or password'}, 400
 
-        current_password = next((item for item in user.get('passwords') if item.get('current') is True), None)
-
         # check if the given password is correct
-        if not current_password or not check_password_hash(current_password.get('password'), data.get('password')):
+        if not PasswordHistory(user.get('passwords')).verify_current(data.get('password')):
             return {'error': 'Incorrect user or password'}, 400
 
         # random version for this token
         rev = random.randint(0, 9999)
-        user_devices = user.get('devices') or []        # get current user's devices
-        if not any(device.get('device_id') == device_id for device in user_devices):
-            # the device is not included for this user
-            current_date_time = datetime.now(timezone.utc)
-            user_devices.append({
-                'device_id': device_id,
-                'rev': rev,
-                'lastUsed': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-                'description': data.get('description')
-            })
-            user.update({'devices': user_devices})
-            mongo.db.users.save(user)
-        else:
-            # device exist for this user, need to update rev and lastUsed
-            current_date_time = datetime.now(timezone.utc)
-            mongo.db.users.update({
-                '_id': user.get('_id'), 'devices.device_id': device_id},
-                {'$set': {
-                    'devices.$.lastUsed': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-                    'devices.$.rev': rev,
-                }},
-                True
-            )
+        current_date_time = datetime.now(timezone.utc)
+        sessions.attach(
+            user.get('_id'), device_id, rev, current_date_time, data.get('description')
+        )
 
         # generate logged-in JWT
         encoded = g.token.generate_logged(user, device_id, ['basics', 'master'], rev)
@@ -183,20 +147,8 @@ class TokensResource(Resource):
         except Exception:
             return {'error': 'Invalid Token'}, 500
 
-        # check that the device_id exist and belongs to the current user
-        user_for_device = mongo.db.users.find_one({
-            '_id': ObjectId(token_to_refresh.get('_id')),
-            'devices': {
-                '$elemMatch': {'device_id': device_id}
-            }})
-
-        # if the device is attached to the user, remove it
-        if user_for_device:
-            mongo.db.users.update(
-                {'_id': user_for_device.get('_id')},
-                {'$pull': {"devices": {'device_id': device_id}}},
-                True
-            )
+        # remove the device when it exist and belongs to the current user
+        if sessions.detach(token_to_refresh.get('_id'), device_id):
             return {'success': True}
 
         return {'error': 'Device not linked to user.'}
@@ -1,6 +1,81 @@
 import jwt
+import calendar
+import threading
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 
+from ..common.metrics import metrics
+
+
+def _now_timestamp():
+    return calendar.timegm(datetime.now(timezone.utc).utctimetuple())
+
+
+class TokenCache:
+    """Bounded LRU cache of verified token claims, keyed by secret and token string"""
+    def __init__(self, max_size=10000, expired_grace=300):
+        self.max_size = max_size
+        self.expired_grace = expired_grace   # seconds an expired token is kept for refresh/logout
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is None:
+                self.misses += 1
+                return None
+
+            # long expired tokens are dropped, a late refresh verifies the signature again
+            exp = claims.get('exp')
+            if isinstance(exp, int) and exp + self.expired_grace <= _now_timestamp():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return claims
+
+    def set(self, key, claims):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = claims
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def configure(self, max_size, expired_grace):
+        with self._lock:
+            self.max_size = max_size
+            self.expired_grace = expired_grace
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+# verified claims shared by every request of this process
+token_cache = TokenCache()
+
 
 class Token:
     """Token functions"""
@@ -9,7 +84,7 @@ class Token:
             token = token.replace("Bearer", "").strip()
         self.token = token              # store the token
         self.config = config            # store the token
-        self.decoded = self.decode()    # decode it as soon it arrives
+        self._claims = None             # verified claims, decoded on first use
 
         if not self.config['SECRET_KEY']:
             self.config['SECRET_KEY'] = 'notsosecret1234567890987654321'
@@ -19,14 +94,46 @@ class Token:
             self.config['TOKEN_TIMEOUT'] = 300
             print('Warning: TOKEN_TIMEOUT not in config file!!!')
 
+    @property
+    def decoded(self):
+        """Claims of a valid, not expired token or an empty dictionary (decoded lazily)"""
+        return self.decode()
+
+    # verify the signature once per token string, expiration is checked on every call
+    def _verified_claims(self):
+        if self._claims is not None:
+            return self._claims
+
+        key = (self.config['SECRET_KEY'], self.token)
+        claims = token_cache.get(key)
+        if claims is None:
+            # verify the signature ignoring the expiration, it is validated below for each use
+            claims = jwt.decode(
+                    self.token,
+                    self.config['SECRET_KEY'],
+                    options={'verify_exp': False},
+                    algorithms=['HS256']
+                )
+            token_cache.set(key, claims)
+
+        self._claims = claims
+        return claims
+
     # decode the token or throw exception
     def decode_token_or_fail(self, verify_exp=True):
-        return jwt.decode(
-                self.token,
-                self.config['SECRET_KEY'],
-                options={'verify_exp': verify_exp},
-                algorithms=['HS256']
-            )
+        with metrics.phase('jwt'):
+            claims = self._verified_claims()
+
+        if verify_exp and 'exp' in claims:
+            try:
+                exp = int(claims['exp'])
+            except (TypeError, ValueError):
+                raise jwt.DecodeError('Expiration Time claim (exp) must be an integer.')
+
+            if exp < _now_timestamp():
+                raise jwt.ExpiredSignatureError('Signature has expired')
+
+        return claims
 
     # decode the token or return an empty dictionary
     def decode(self):
@@ -48,7 +155,8 @@ class Token:
     def generate(self, payload):
         # append default expiration time
         payload['exp'] = datetime.now(timezone.utc) + timedelta(seconds=self.config['TOKEN_TIMEOUT'])
-        return jwt.encode(payload, self.config['SECRET_KEY'], algorithm='HS256')
+        with metrics.phase('jwt'):
+            return jwt.encode(payload, self.config['SECRET_KEY'], algorithm='HS256')
 
     def generate_public(self, device_id, allowed):
         return self.generate({
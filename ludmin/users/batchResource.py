@@ -0,0 +1,146 @@
+from flask_restful import Resource
+from flask_pymongo import ObjectId
+
+from flask import g, current_app
+from ..common import Schema, Field
+from . import repository, sessions
+from .profiles import profiles
+from .userResource import profile_summary
+
+# batch lists by name
+BATCHES = {
+    'user_ids': Schema(Field('user_ids', list, required=True)),
+    'items': Schema(Field('items', list, required=True)),
+}
+
+
+def _batch(name, item_type=str):
+    """Items of the request's list, or the error response when invalid or above BATCH_MAX_SIZE"""
+    items = BATCHES[name].parse().get(name)
+
+    max_size = current_app.config.get('BATCH_MAX_SIZE', 500)
+    if len(items) > max_size:
+        return None, ({'error': 'Too many items, the max is %d.' % max_size}, 400)
+
+    if not all(isinstance(item, item_type) for item in items):
+        return None, ({'error': 'Invalid %s.' % name}, 400)
+
+    return items, None
+
+
+def _object_ids(user_ids):
+    """Valid ids as ObjectId by the given string (invalid ones are not included)"""
+    return {user_id: ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)}
+
+
+class BatchProfilesResource(Resource):
+    def options(self):
+        pass
+
+    def post(self):
+        """Full profiles of several users (as GET /users/<user_id>), a result per id"""
+        if not g.token.has_access('master'):
+            return {'error': 'Not allowed'}, 401
+
+        user_ids, error = _batch('user_ids')
+        if error:
+            return error
+
+        object_ids = _object_ids(user_ids)
+        users = repository.find_many(set(object_ids.values()), repository.PROFILE_SUMMARY)
+        device_counts = sessions.count_for_users(list(users)) if users else {}
+
+        results = []
+        for user_id in user_ids:
+            user = users.get(object_ids.get(user_id))
+            if user_id not in object_ids:
+                results.append({'user_id': user_id, 'error': 'Invalid id'})
+            elif not user:
+                results.append({'user_id': user_id, 'error': 'Not found'})
+            else:
+                results.append({
+                    'user_id': user_id,
+                    'success': True,
+                    'profile': profile_summary(user, device_counts.get(user.get('_id')), True),
+                })
+
+        return {'success': True, 'results': results}
+
+
+class BatchLogoutResource(Resource):
+    def options(self):
+        pass
+
+    def post(self):
+        """Logout devices of several users: every device, or the given device_id only"""
+        if not g.token.has_access('master'):
+            return {'error': 'Not allowed'}, 401
+
+        items, error = _batch('items', dict)
+        if error:
+            return error
+
+        object_ids = _object_ids(str(item.get('user_id')) for item in items)
+
+        # an item without device_id logs out every device of the user, whatever the user's other items
+        every_device = {object_ids.get(str(item.get('user_id'))) for item in items if not item.get('device_id')}
+        device_ids = {}
+        for item in items:
+            user_id = object_ids.get(str(item.get('user_id')))
+            if user_id and item.get('device_id') and user_id not in every_device:
+                device_ids.setdefault(user_id, []).append(item.get('device_id'))
+
+        detached = sessions.detach_many(set(object_ids.values()), device_ids) if object_ids else {}
+
+        results = []
+        for item in items:
+            user_id = object_ids.get(str(item.get('user_id')))
+            if not user_id:
+                results.append({'user_id': item.get('user_id'), 'error': 'Invalid id'})
+                continue
+
+            devices = [device_id for device_id in detached.get(user_id, [])
+                       if not item.get('device_id') or device_id == item.get('device_id')]
+            if item.get('device_id') and not devices:
+                results.append({'user_id': item.get('user_id'), 'device_id': item.get('device_id'),
+                                'error': 'Device not linked to user.'})
+            else:
+                results.append({'user_id': item.get('user_id'), 'success': True, 'devices': devices})
+
+        return {'success': True, 'results': results}
+
+
+class BatchNamesResource(Resource):
+    def options(self):
+        pass
+
+    def put(self):
+        """Update the full_name of several users"""
+        if not g.token.has_access('master'):
+            return {'error': 'Not allowed'}, 401
+
+        items, error = _batch('items', dict)
+        if error:
+            return error
+
+        object_ids = _object_ids(str(item.get('user_id')) for item in items)
+        existing = repository.find_many(set(object_ids.values()), repository.ID_ONLY) if object_ids else {}
+
+        results = []
+        updates = {}
+        for item in items:
+            user_id = object_ids.get(str(item.get('user_id')))
+            if not user_id:
+                results.append({'user_id': item.get('user_id'), 'error': 'Invalid id'})
+            elif not item.get('full_name') or not isinstance(item.get('full_name'), str):
+                results.append({'user_id': item.get('user_id'), 'error': 'Missing full_name'})
+            elif user_id not in existing:
+                results.append({'user_id': item.get('user_id'), 'error': 'Not found'})
+            else:
+                updates[user_id] = {'full_name': item.get('full_name')}
+                results.append({'user_id': item.get('user_id'), 'success': True})
+
+        repository.set_many(updates)
+        profiles.invalidate(*updates)
+
+        return {'success': True, 'results': results}
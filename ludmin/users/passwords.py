@@ -0,0 +1,74 @@
+from .. import hasher
+
+
+class PasswordHistory:
+    """
+    Passwords stored for an user (current and previous ones).
+    Every stored hash is checked at most once per given password, results are kept for the request.
+    """
+    def __init__(self, passwords, limit=None):
+        self.stored = passwords         # as read, the update is only applied if still the same
+        self.passwords = [dict(item) for item in passwords or []]
+        self.limit = limit              # max passwords kept, None to keep the full history
+        self._checked = {}
+
+    def _matches(self, index, password):
+        key = (index, password)
+        if key not in self._checked:
+            self._checked[key] = hasher.check(self.passwords[index].get('password'), password)
+
+        return self._checked[key]
+
+    def verify_current(self, password):
+        """Check the password against the current hash only"""
+        return any(self._matches(index, password)
+                   for index, item in enumerate(self.passwords)
+                   if item.get('current') is True)
+
+    def find(self, password):
+        """Index of the stored password matching the given one, None if never used"""
+        # the current password first, setting the same password again costs a single check
+        indexes = sorted(range(len(self.passwords)),
+                         key=lambda index: self.passwords[index].get('current') is not True)
+        return next((index for index in indexes if self._matches(index, password)), None)
+
+    def unchanged(self):
+        """Filter matching the user only if the passwords were not changed since read"""
+        return {'passwords': self.stored}
+
+    def use(self, password, timestamp):
+        """
+        Make the given password the current one, appending it when not used before.
+        Returns the fields for a $set update with the changes, to apply along with `unchanged()`:
+        positions are the ones read and the whole history is written for a new password.
+        """
+        index = self.find(password)
+
+        # a password used before only needs its flags changed
+        if index is not None:
+            updates = {}
+            for position, item in enumerate(self.passwords):
+                is_current = position == index
+                if is_current != item.get('current'):
+                    item.update({'current': is_current, 'updatedAt': timestamp})
+                    updates['passwords.%d.current' % position] = is_current
+                    updates['passwords.%d.updatedAt' % position] = timestamp
+
+            return updates
+
+        # new password, unflag the previous ones and append it
+        for item in self.passwords:
+            if item.get('current') is not False:
+                item.update({'current': False, 'updatedAt': timestamp})
+
+        self.passwords.append({
+            'current': True,
+            'password': hasher.generate(password),
+            'insertedAt': timestamp,
+        })
+
+        if self.limit:
+            del self.passwords[:-self.limit]
+
+        # hashes are copied as they are, nothing is hashed again
+        return {'passwords': self.passwords}
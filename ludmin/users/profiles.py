@@ -0,0 +1,104 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from flask import request
+
+from ..common import serializer
+
+
+def etag(body):
+    """Strong ETag of a response body (as encoded by output_json)"""
+    return '"%s"' % hashlib.sha1(serializer.dumps(body).encode('utf-8')).hexdigest()
+
+
+class ProfileCache:
+    """
+    Public profiles (user_id and full_name) with their ETag, kept PROFILE_CACHE_TTL seconds in a per
+    process LRU of PROFILE_CACHE_SIZE entries. Updates made by this process invalidate the entry, the TTL
+    bounds how long other workers may answer with the previous name.
+    """
+    def __init__(self):
+        self.ttl = 60
+        self.max_size = 10000
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def init_app(self, app):
+        self.ttl = app.config.get('PROFILE_CACHE_TTL', 60)
+        self.max_size = app.config.get('PROFILE_CACHE_SIZE', 10000)
+        with self._lock:
+            self._entries.clear()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.not_modified = 0
+
+    def get(self, user_id):
+        """Cached (profile, etag) or None when unknown or too old"""
+        if self.ttl <= 0:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if time.time() - entry[2] > self.ttl:
+                del self._entries[user_id]
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def set(self, user_id, profile):
+        """Cache the public profile, returns its ETag"""
+        profile_etag = etag(profile)
+        if self.ttl <= 0:
+            return profile_etag
+
+        with self._lock:
+            self._entries[user_id] = (profile, profile_etag, time.time())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+        return profile_etag
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(str(user_id), None)
+
+    def conditional(self, body, body_etag):
+        """The response for the body: a 304 without body when the client already has this ETag"""
+        if request.if_none_match.contains_weak(body_etag.strip('"')):
+            with self._lock:
+                self.not_modified += 1
+            return None, 304, {'ETag': body_etag}
+
+        return body, 200, {'ETag': body_etag}
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'not_modified': self.not_modified,
+        }
+
+
+profiles = ProfileCache()
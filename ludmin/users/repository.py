@@ -0,0 +1,203 @@
+from flask import g, has_app_context
+from bson.son import SON
+from flask_pymongo import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .. import mongo
+from ..common import keyset_page, keyset_stream, metrics
+
+# projections, each endpoint loads only the fields it uses
+PUBLIC_PROFILE = {'full_name': 1}
+FULL_PROFILE = {'passwords.password': 0}
+# full profile without the histories: the current email only (as entered), no password hashes
+PROFILE_SUMMARY = {
+    'full_name': 1,
+    'all_emails': 1,
+    'emails': {'$elemMatch': {'current': True}},
+    'passwords.current': 1,
+    'passwords.insertedAt': 1,
+    'passwords.updatedAt': 1,
+}
+LISTING = {'_id': 0, 'passwords.password': 0}
+LOGIN = {'full_name': 1, 'passwords': 1}
+PASSWORDS = {'passwords': 1}
+CREDENTIALS = {'passwords': 1, 'emails': 1}
+ID_ONLY = {'_id': 1}
+
+# duplicate key error code
+DUPLICATE_KEY = 11000
+
+# read-modify-write updates applied only if the fields read are unchanged, attempts before a conflict
+UPDATE_ATTEMPTS = 3
+
+
+def _round_trip():
+    """Count a database round trip for the current request, the block is timed as the mongo phase"""
+    if has_app_context():
+        g.db_round_trips = g.get('db_round_trips', 0) + 1
+
+    return metrics.phase('mongo')
+
+
+def round_trips():
+    """Database round trips made by the users repository on the current request"""
+    return g.get('db_round_trips', 0) if has_app_context() else 0
+
+
+def _object_id(user_id):
+    return user_id if isinstance(user_id, ObjectId) else ObjectId(user_id)
+
+
+def find_by_id(user_id, projection=None):
+    """Load an user by id (raises for invalid ids)"""
+    user_id = _object_id(user_id)
+    with _round_trip():
+        return mongo.db.users.find_one({'_id': user_id}, projection)
+
+
+def find_many(user_ids, projection=None):
+    """Users of the given ids (ObjectId) by id, the missing ones are not included"""
+    with _round_trip():
+        return {user.get('_id'): user for user in mongo.db.users.find({'_id': {'$in': list(user_ids)}}, projection)}
+
+
+def emails_page(user_id, limit, offset=0):
+    """
+    One page of the user's emails by last use: the current one, then by when they stopped being current.
+    Returns the emails and the offset of the next page (None on the last page).
+    """
+    with _round_trip():
+        emails = [user.get('emails') for user in mongo.db.users.aggregate([
+            {'$match': {'_id': _object_id(user_id)}},
+            {'$project': {'_id': 0, 'emails': 1}},
+            {'$unwind': '$emails'},
+            {'$sort': SON([('emails.current', -1), ('emails.updatedAt', -1), ('emails.insertedAt', -1)])},
+            {'$skip': offset},
+            {'$limit': limit + 1},
+        ])]
+
+    if len(emails) > limit:
+        return emails[:limit], offset + limit
+    return emails, None
+
+
+def normalize_email(email):
+    """Lookup form of an email: emails are compared trimmed and case insensitive"""
+    return email.strip().lower() if isinstance(email, str) else email
+
+
+def email_fields(emails):
+    """
+    Lookup fields for the user's emails: current_email (unique, not set without a current email)
+    and all_emails, every email ever used by the user (unique across users)
+    """
+    fields = {'all_emails': sorted({normalize_email(item.get('email')) for item in emails if item.get('email')})}
+    current = next((item.get('email') for item in emails if item.get('current') is True), None)
+    if current:
+        fields['current_email'] = normalize_email(current)
+
+    return fields
+
+
+def find_by_current_email(email, projection=None):
+    with _round_trip():
+        return mongo.db.users.find_one({'current_email': normalize_email(email)}, projection)
+
+
+def new_user(full_name, email, password_hash, timestamp):
+    """Document of a new user (signup and imports), the email is not verified"""
+    return {
+        'full_name': full_name,
+        'current_email': normalize_email(email),
+        'all_emails': [normalize_email(email)],
+        'emails': [
+            {
+                'email': email,
+                'verified': False,
+                'current': True,
+                'insertedAt': timestamp,
+            }
+        ],
+        'passwords': [
+            {
+                'current': True,
+                'password': password_hash,
+                'insertedAt': timestamp,
+            }
+        ],
+        'insertedAt': timestamp,
+    }
+
+
+def insert(user):
+    """Insert a new user, raises DuplicateKeyError when one of its emails is already used"""
+    with _round_trip():
+        return mongo.db.users.insert_one(user).inserted_id
+
+
+def set_fields(user_id, fields, unchanged=None):
+    """
+    Atomic $set of the given fields. With `unchanged`, only applied if the user still matches it
+    (fields as read for a read-modify-write update). Returns whether the user matched.
+    """
+    if not fields:
+        return False
+
+    query = dict(unchanged or {}, _id=_object_id(user_id))
+    with _round_trip():
+        return mongo.db.users.update_one(query, {'$set': fields}).matched_count > 0
+
+
+def set_many(updates):
+    """Atomic $set of the fields of several users in a single unordered bulk write ({user_id: fields})"""
+    if not updates:
+        return
+
+    with _round_trip():
+        mongo.db.users.bulk_write([
+            UpdateOne({'_id': _object_id(user_id)}, {'$set': fields}) for user_id, fields in updates.items()
+        ], ordered=False)
+
+
+def page(limit, after=None):
+    """Users listing page (without password hashes) and the cursor for the next one"""
+    with _round_trip():
+        return keyset_page(mongo.db.users, {}, LISTING, limit, after)
+
+
+def stream(limit=None, after=None):
+    """NDJSON streaming response with the users (without password hashes)"""
+    with _round_trip():
+        return keyset_stream(mongo.db.users, {}, LISTING, limit, after)
+
+
+def migrate_email_fields(batch_size=500):
+    """
+    Set current_email and all_emails on the users created before them, by _id order.
+    Can be stopped and run again. Returns the number of users updated and the ids of the users
+    whose emails collide with other users' once normalized (left without the fields).
+    """
+    updated = 0
+    conflicts = []
+    last_id = None
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id else {}
+        users = list(mongo.db.users.find(query, {'emails': 1}).sort('_id', 1).limit(batch_size))
+        if not users:
+            break
+
+        operations = [UpdateOne({'_id': user.get('_id')}, {'$set': email_fields(user.get('emails') or [])})
+                      for user in users]
+        try:
+            updated += mongo.db.users.bulk_write(operations, ordered=False).modified_count
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error.get('code') != DUPLICATE_KEY for error in errors):
+                raise
+            updated += e.details.get('nModified', 0)
+            conflicts.extend(users[error.get('index')].get('_id') for error in errors)
+
+        last_id = users[-1].get('_id')
+
+    return updated, conflicts
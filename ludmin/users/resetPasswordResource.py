@@ -1,10 +1,22 @@
-from flask_restful import Resource, reqparse
+from flask_restful import Resource
 from datetime import datetime, timezone
-from werkzeug.security import generate_password_hash, check_password_hash
 import random
 
-from flask import g
-from .. import mongo
+from flask import g, current_app
+from ..common import page_args, InvalidCursor, limiter, Schema, Field
+from .passwords import PasswordHistory
+from . import repository, resets
+
+RESET_REQUEST = Schema(
+    Field('email', required=True),
+)
+
+RESET = Schema(
+    Field('email', required=True),
+    Field('code', required=True),
+    Field('password', required=True),
+    Field('password_confirmation', required=True),
+)
 
 
 class ResetPasswordResource(Resource):
@@ -17,7 +29,16 @@ class ResetPasswordResource(Resource):
         if not g.token.has_access('master'):
             return {'error': 'Not allowed'}, 401
 
-        return {'success': True, 'results': mongo.db.reset_requests.find({}, {'_id': 0})}
+        try:
+            args = page_args()
+        except InvalidCursor as e:
+            return {'error': str(e)}, 400
+
+        if args['stream']:
+            return resets.stream(args['stream_limit'], args['after'])
+
+        results, next_after = resets.page(args['limit'], args['after'])
+        return {'success': True, 'results': results, 'next': next_after}
 
     def post(self):
         """Generate a reset password code"""
@@ -25,39 +46,21 @@ class ResetPasswordResource(Resource):
             return {'error': 'Not allowed'}, 401
 
         # validate fields
-        parser = reqparse.RequestParser()
-        parser.add_argument('email', required=True)
-        data = parser.parse_args()
+        data = RESET_REQUEST.parse()
 
         # the email must exist and must be the current one
-        user_for_email = mongo.db.users.find_one({
-            'emails': {
-                '$elemMatch': {
-                    'email': data.get('email'),
-                    'current': True
-                }
-            }
-        })
+        user_for_email = repository.find_by_current_email(data.get('email'), repository.ID_ONLY)
 
         # we can not use the email if registered on other user
         if not user_for_email:
             return {'error': 'Email not registered for any user.'}, 400
 
-        # generate a reset password record
-        current_date_time = datetime.now(timezone.utc)
+        # generate a reset password record (replaces the previous ones, removed once expired)
         generated_code = random.randint(1000, 9999)
-        new_reset = {
-            'email': data.get('email'),
-            'sent': False,
-            'enabled': True,
-            'failures': 0,
-            'code': str(generated_code),
-            'insertedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-        }
-
-        mongo.db.reset_requests.insert(new_reset)
+        resets.create(data.get('email'), str(generated_code), current_app.config.get('RESET_CODE_TIMEOUT', 3600))
         return {'success': True}
 
+    @limiter.limit('reset')
     def put(self):
         """Set a new password given a reset code"""
         if not g.token.has_access('public'):
@@ -66,82 +69,41 @@ class ResetPasswordResource(Resource):
         current_date_time = datetime.now(timezone.utc)
 
         # validate fields
-        parser = reqparse.RequestParser()
-        parser.add_argument('email', required=True)
-        parser.add_argument('code', required=True)
-        parser.add_argument('password', required=True)
-        parser.add_argument('password_confirmation', required=True)
-        data = parser.parse_args()
-
-        # load the reset record
-        reset_record = mongo.db.reset_requests.find_one({
-            'email': data.get('email'),
-            'enabled': True,
-            'failures': {"$lt": 4}
-        })
-        if not reset_record:
-            return {'error': 'No reset request found for this email.'}, 400
-
-        # load the user for the provided email
-        user = mongo.db.users.find_one({
-            'emails': {
-                '$elemMatch': {
-                    'email': data.get('email'),
-                    'current': True
-                }
-            }
-        })
-        if not user:
-            return {'error': 'Unable to find active email.'}, 400
+        data = RESET.parse()
 
         # validate the new password
         if data.get('password') != data.get('password_confirmation'):
             return {'error': 'Password confirmation does not match.'}, 400
 
-        # if the code is incorrect, update failures count
-        if reset_record.get('code') != data.get('code'):
-            reset_record.update({
-                'failures': reset_record.get('failures') + 1,
-                'updatedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S')
-            })
-            mongo.db.reset_requests.save(reset_record)
+        # load the user's passwords for the provided email, before the code is used
+        user = repository.find_by_current_email(data.get('email'), repository.PASSWORDS)
+        if not user:
+            return {'error': 'Unable to find active email.'}, 400
+
+        # use the reset code, a wrong code counts a failure
+        consumed = resets.consume(data.get('email'), data.get('code'))
+        if consumed is None:
+            return {'error': 'No reset request found for this email.'}, 400
+
+        if not consumed:
             return {'error': 'Invalid code, try again.'}, 400
 
-        # everything is valid, invalidate the reset record
-        reset_record.update({
-            'enabled': False,
-            'updatedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S')
-        })
-        mongo.db.registrations.save(reset_record)
-
-        # append new password if not already used before
-        user_passwords = user.get('passwords') or []
-        if not any(check_password_hash(currentPassword.get('password'), data.get('password'))
-                   for currentPassword in user_passwords
-                   ):
-            user_passwords.append({
-                'current': True,
-                'password': generate_password_hash(data.get('password')),
-                'insertedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-            })
-
-        # mark the current password
-        for pass_to_unflag in user_passwords:
-            is_current = check_password_hash(pass_to_unflag.get('password'), data.get('password'))
-
-            # is not the current but was already used, update hash
-            if is_current != pass_to_unflag.get('current'):
-                pass_to_unflag.update({
-                    'updatedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-                })
-
-            # mark current or not
-            pass_to_unflag.update({
-                'current': is_current
-            })
-
-        user.update({'passwords': user_passwords})
-
-        # send the changes to the db
-        mongo.db.users.save(user)
+        # make it the current password, appended if not already used before. Applied only if the passwords
+        # were not changed meanwhile, otherwise they are loaded again (the code is already used)
+        for attempt in range(repository.UPDATE_ATTEMPTS):
+            if attempt:
+                user = repository.find_by_id(user.get('_id'), repository.PASSWORDS)
+                if not user:
+                    return {'error': 'Unable to find active email.'}, 400
+
+            password_history = PasswordHistory(user.get('passwords'),
+                                               current_app.config.get('PASSWORD_HISTORY_LIMIT'))
+            updates = password_history.use(data.get('password'), current_date_time)
+
+            # send the changes to the db
+            if not updates or repository.set_fields(user.get('_id'), updates, password_history.unchanged()):
+                break
+        else:
+            return {'error': 'User changed while updating, try again.'}, 409
+
         return {'success': True}
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta, timezone
+from pymongo import DESCENDING, ReturnDocument
+
+from .. import mongo
+from ..common import keyset_page, keyset_stream
+from .repository import _round_trip, normalize_email
+
+# wrong codes accepted before the request is locked
+MAX_FAILURES = 4
+
+# reset requests as listed (for the task sending the codes)
+LISTING = {'_id': 0}
+
+
+def _usable(email, now):
+    # enabled, not locked and not expired (expired requests are removed by the TTL index, with some delay)
+    return {
+        'email': email,
+        'enabled': True,
+        'failures': {'$lt': MAX_FAILURES},
+        'expiresAt': {'$gt': now},
+    }
+
+
+def create(email, code, timeout):
+    """New reset request for the email, the previous ones are disabled (a single usable code per email)"""
+    now = datetime.now(timezone.utc)
+    email = normalize_email(email)
+    with _round_trip():
+        mongo.db.reset_requests.update_many(
+            {'email': email, 'enabled': True},
+            {'$set': {'enabled': False, 'updatedAt': now}}
+        )
+
+    with _round_trip():
+        mongo.db.reset_requests.insert_one({
+            'email': email,
+            'sent': False,
+            'enabled': True,
+            'failures': 0,
+            'code': code,
+            'insertedAt': now,
+            'expiresAt': now + timedelta(seconds=timeout),
+        })
+
+
+def consume(email, code):
+    """
+    Disable the email's reset request when the code matches (True), else count a failure on it.
+    Returns None when the email has no usable request.
+    Each step is a single atomic update, concurrent guesses can not use the same request twice.
+    """
+    now = datetime.now(timezone.utc)
+    email = normalize_email(email)
+    with _round_trip():
+        consumed = mongo.db.reset_requests.find_one_and_update(
+            dict(_usable(email, now), code=code),
+            {'$set': {'enabled': False, 'updatedAt': now}},
+            projection={'email': 1}
+        )
+    if consumed:
+        return True
+
+    with _round_trip():
+        failed = mongo.db.reset_requests.find_one_and_update(
+            _usable(email, now),
+            {'$inc': {'failures': 1}, '$set': {'updatedAt': now}},
+            projection={'email': 1},
+            sort=[('_id', DESCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    return False if failed else None
+
+
+def page(limit, after=None):
+    with _round_trip():
+        return keyset_page(mongo.db.reset_requests, {}, LISTING, limit, after)
+
+
+def stream(limit=None, after=None):
+    with _round_trip():
+        return keyset_stream(mongo.db.reset_requests, {}, LISTING, limit, after)
+
+
+def remove_expired():
+    """Remove the expired reset requests right away (by the TTL index), returns the number removed"""
+    with _round_trip():
+        return mongo.db.reset_requests.delete_many({'expiresAt': {'$lt': datetime.now(timezone.utc)}}).deleted_count
@@ -5,7 +5,9 @@ from ..common import output_json
 
 from .usersResource import UsersResource
 from .userResource import UserResource
+from .userHistoryResource import UserDevicesResource, UserEmailsResource
 from .resetPasswordResource import ResetPasswordResource
+from .batchResource import BatchProfilesResource, BatchLogoutResource, BatchNamesResource
 
 users_bp = Blueprint('users_api', __name__)
 api = Api(users_bp)
@@ -13,4 +15,9 @@ api.representations = {'application/json': output_json}
 
 api.add_resource(UsersResource, '')
 api.add_resource(UserResource, '/<user_id>')
+api.add_resource(UserDevicesResource, '/<user_id>/devices')
+api.add_resource(UserEmailsResource, '/<user_id>/emails')
 api.add_resource(ResetPasswordResource, '/reset')
+api.add_resource(BatchProfilesResource, '/batch/profiles')
+api.add_resource(BatchLogoutResource, '/batch/logout')
+api.add_resource(BatchNamesResource, '/batch/names')
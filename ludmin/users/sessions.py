@@ -0,0 +1,169 @@
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING, DESCENDING, DeleteOne, ReturnDocument, UpdateOne
+
+from .. import mongo
+from .repository import _round_trip, _object_id
+from .touches import touches
+
+# devices as listed on the user's profile
+DEVICE = {'_id': 0, 'device_id': 1, 'rev': 1, 'lastUsed': 1, 'description': 1}
+
+
+def attach(user_id, device_id, rev, timestamp, description):
+    """Link a device to the user (or update its rev when already linked)"""
+    user_id = _object_id(user_id)
+    with _round_trip():
+        mongo.db.sessions.update_one({
+            'user_id': user_id, 'device_id': device_id},
+            {'$set': {
+                'rev': rev,
+                'lastUsed': timestamp,
+            }, '$setOnInsert': {
+                'description': description,
+            }},
+            upsert=True
+        )
+
+
+def refresh(user_id, device_id, token_rev, rev, timestamp):
+    """
+    Rotate the rev of a device still linked with the token's rev, None when not linked anymore.
+    The rev is written right away, lastUsed is buffered.
+    """
+    user_id = _object_id(user_id)
+    with _round_trip():
+        session = mongo.db.sessions.find_one_and_update({
+            'user_id': user_id,
+            'device_id': device_id,
+            'rev': token_rev,
+            },
+            {'$set': {
+                'rev': rev,
+            }},
+            projection={'user_id': 1},
+            return_document=ReturnDocument.AFTER
+        )
+
+    if session:
+        touches.touch(user_id, device_id, timestamp)
+
+    return session
+
+
+def detach(user_id, device_id):
+    """Unlink the device from the user, False when it was not linked"""
+    with _round_trip():
+        return mongo.db.sessions.delete_one({'user_id': _object_id(user_id), 'device_id': device_id}).deleted_count > 0
+
+
+def page_for_user(user_id, limit, offset=0):
+    """One page of the user's devices by last use, and the offset of the next page (None on the last page)"""
+    with _round_trip():
+        devices = list(mongo.db.sessions.find({'user_id': _object_id(user_id)}, DEVICE)
+                       .sort([('lastUsed', DESCENDING), ('device_id', ASCENDING)])
+                       .skip(offset).limit(limit + 1))
+
+    if len(devices) > limit:
+        return devices[:limit], offset + limit
+    return devices, None
+
+
+def count_for_user(user_id):
+    """Number of devices linked to the user"""
+    with _round_trip():
+        return mongo.db.sessions.count({'user_id': _object_id(user_id)})
+
+
+def count_for_users(user_ids):
+    """Number of devices linked to each of the users, {user_id: count}"""
+    counts = {user_id: 0 for user_id in user_ids}
+    with _round_trip():
+        for group in mongo.db.sessions.aggregate([
+            {'$match': {'user_id': {'$in': list(user_ids)}}},
+            {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}},
+        ]):
+            counts[group.get('_id')] = group.get('count')
+
+    return counts
+
+
+def detach_many(user_ids, device_ids=None):
+    """
+    Unlink devices in bulk: every device of the users, but only the listed ones for the users included
+    in device_ids ({user_id: [device_id]}). Returns the detached device ids per user.
+    """
+    query = {'user_id': {'$in': list(user_ids)}}
+    with _round_trip():
+        linked = list(mongo.db.sessions.find(query, {'_id': 0, 'user_id': 1, 'device_id': 1}))
+
+    detached = {user_id: [] for user_id in user_ids}
+    for session in linked:
+        wanted = (device_ids or {}).get(session.get('user_id'))
+        if wanted is None or session.get('device_id') in wanted:
+            detached[session.get('user_id')].append(session.get('device_id'))
+
+    operations = [DeleteOne({'user_id': user_id, 'device_id': device_id})
+                  for user_id, devices in detached.items() for device_id in devices]
+    if operations:
+        with _round_trip():
+            mongo.db.sessions.bulk_write(operations, ordered=False)
+
+    return detached
+
+
+def migrate_embedded_devices(batch_size=500):
+    """
+    Move the devices embedded on the user documents into the sessions collection.
+    Can be stopped and run again, sessions created after the deploy are kept.
+    Returns the number of users and devices moved.
+    """
+    moved_users = 0
+    moved_devices = 0
+    while True:
+        users = list(mongo.db.users.find({'devices': {'$exists': True}}, {'devices': 1}).limit(batch_size))
+        if not users:
+            break
+
+        operations = [
+            UpdateOne(
+                {'user_id': user.get('_id'), 'device_id': device.get('device_id')},
+                {'$setOnInsert': {
+                    'rev': device.get('rev'),
+                    'lastUsed': device.get('lastUsed'),
+                    'description': device.get('description'),
+                }},
+                upsert=True
+            )
+            for user in users for device in (user.get('devices') or []) if device.get('device_id')
+        ]
+        if operations:
+            mongo.db.sessions.bulk_write(operations, ordered=False)
+
+        # devices are removed from the users only once their sessions are written
+        mongo.db.users.update_many(
+            {'_id': {'$in': [user.get('_id') for user in users]}},
+            {'$unset': {'devices': ''}}
+        )
+
+        moved_users += len(users)
+        moved_devices += len(operations)
+
+    return moved_users, moved_devices
+
+
+def remove_idle(idle_days, batch_size=1000):
+    """
+    Unlink the devices not used for idle_days (by the lastUsed index), in batches.
+    Returns the number of devices removed.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=idle_days)
+    removed = 0
+    while True:
+        idle = [session.get('_id') for session in
+                mongo.db.sessions.find({'lastUsed': {'$lt': cutoff}}, {'_id': 1}).limit(batch_size)]
+        if not idle:
+            break
+
+        removed += mongo.db.sessions.delete_many({'_id': {'$in': idle}, 'lastUsed': {'$lt': cutoff}}).deleted_count
+
+    return removed
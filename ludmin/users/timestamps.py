@@ -0,0 +1,101 @@
+"""
+Migration of the timestamps stored as '%Y-%m-%d %H:%M:%S' strings to BSON dates (UTC). Documents are
+streamed by _id in batches and each one is updated only if its strings did not change meanwhile,
+the migration can be stopped and run again.
+"""
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+
+from .. import mongo
+
+FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# timestamp fields per collection, the array ones as (array, field)
+FIELDS = {
+    'users': ['insertedAt', ('emails', 'insertedAt'), ('emails', 'updatedAt'),
+              ('passwords', 'insertedAt'), ('passwords', 'updatedAt')],
+    'sessions': ['lastUsed'],
+    'reset_requests': ['insertedAt', 'updatedAt'],
+}
+
+
+def parse(value):
+    """UTC date of a legacy timestamp string, None when it can not be parsed"""
+    try:
+        return datetime.strptime(value, FORMAT).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def _paths(document, fields):
+    """(path, value) of the document's fields still stored as strings"""
+    for field in fields:
+        if isinstance(field, str):
+            if isinstance(document.get(field), str):
+                yield field, document.get(field)
+            continue
+
+        array, name = field
+        for position, item in enumerate(document.get(array) or []):
+            if isinstance(item, dict) and isinstance(item.get(name), str):
+                yield '%s.%d.%s' % (array, position, name), item.get(name)
+
+
+def _conversion(collection, document, reset_timeout):
+    """UpdateOne converting the document's string timestamps, None when there is nothing to convert"""
+    query = {'_id': document.get('_id')}
+    dates = {}
+    for path, value in _paths(document, FIELDS[collection]):
+        date = parse(value)
+        if date is not None:
+            query[path] = value
+            dates[path] = date
+
+    # legacy reset requests have no expiry, they expire as the new ones (TTL index)
+    if collection == 'reset_requests' and 'expiresAt' not in document and dates.get('insertedAt'):
+        query['expiresAt'] = {'$exists': False}
+        dates['expiresAt'] = dates.get('insertedAt') + timedelta(seconds=reset_timeout)
+
+    return UpdateOne(query, {'$set': dates}) if dates else None
+
+
+def migrate_collection(collection, batch_size=500, reset_timeout=3600):
+    """
+    Convert the string timestamps of a collection, a batch of documents in memory at a time.
+    Returns the number of documents converted and the ones with unparseable strings (left as they are).
+    """
+    fields = FIELDS[collection]
+    projection = {field if isinstance(field, str) else field[0]: 1 for field in fields}
+    if collection == 'reset_requests':
+        projection['expiresAt'] = 1
+
+    pending = {'$or': [{field if isinstance(field, str) else '.'.join(field): {'$type': 'string'}}
+                       for field in fields]}
+
+    converted = 0
+    invalid = 0
+    last_id = None
+    while True:
+        query = dict(pending, _id={'$gt': last_id}) if last_id else pending
+        documents = list(mongo.db[collection].find(query, projection).sort('_id', 1).limit(batch_size))
+        if not documents:
+            break
+
+        operations = []
+        for document in documents:
+            operation = _conversion(collection, document, reset_timeout)
+            if operation:
+                operations.append(operation)
+            if any(parse(value) is None for _, value in _paths(document, fields)):
+                invalid += 1
+
+        if operations:
+            converted += mongo.db[collection].bulk_write(operations, ordered=False).modified_count
+        last_id = documents[-1].get('_id')
+
+    return converted, invalid
+
+
+def migrate(batch_size=500, reset_timeout=3600):
+    """Convert the string timestamps of every collection, returns {collection: (converted, invalid)}"""
+    return {collection: migrate_collection(collection, batch_size, reset_timeout) for collection in FIELDS}
@@ -0,0 +1,127 @@
+import atexit
+import os
+import threading
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from .. import mongo
+from .repository import _round_trip
+
+
+class TouchBuffer:
+    """
+    Write-behind buffer for the sessions' lastUsed, only informational so it is not written on every refresh.
+    Touches are coalesced per device and flushed with bulk_write every LAST_USED_FLUSH_INTERVAL seconds,
+    or as soon as LAST_USED_MAX_BATCH devices are pending, and on shutdown.
+    """
+    def __init__(self):
+        self.app = None
+        self.flush_interval = 5
+        self.max_batch = 500
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._registered = False
+        self.touched = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_interval = app.config.get('LAST_USED_FLUSH_INTERVAL', 5)
+        self.max_batch = app.config.get('LAST_USED_MAX_BATCH', 500)
+
+        # pending touches are written before the process exits
+        if not self._registered:
+            atexit.register(self.flush)
+            self._registered = True
+
+    def _ensure_worker(self):
+        # one flusher thread per process, started again in forked workers
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = {}
+            self._thread = threading.Thread(target=self._run, name='lastUsed-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def touch(self, user_id, device_id, timestamp):
+        """Record the device's last use, written on the next flush (synchronously when disabled)"""
+        if not self.flush_interval or self.flush_interval <= 0:
+            with _round_trip():
+                self._write({(user_id, device_id): timestamp})
+            return
+
+        with self._lock:
+            self._ensure_worker()
+            key = (user_id, device_id)
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = max(timestamp, self._pending.get(key, timestamp))
+            self.touched += 1
+            full = len(self._pending) >= self.max_batch
+
+        if full:
+            self._wakeup.set()
+
+    def _write(self, touches):
+        # $max keeps the newest value if a later write already landed, sessions removed meanwhile are skipped
+        operations = [
+            UpdateOne({'user_id': user_id, 'device_id': device_id}, {'$max': {'lastUsed': timestamp}})
+            for (user_id, device_id), timestamp in touches.items()
+        ]
+        with self.app.app_context():
+            for start in range(0, len(operations), self.max_batch):
+                mongo.db.sessions.bulk_write(operations[start:start + self.max_batch], ordered=False)
+
+    def flush(self):
+        """Write the pending touches, returns the number of devices written"""
+        if self.app is None:
+            return 0
+
+        with self._flush_lock:
+            with self._lock:
+                touches, self._pending = self._pending, {}
+
+            if not touches:
+                return 0
+
+            try:
+                self._write(touches)
+            except PyMongoError as e:
+                # keep them for the next flush, unless a newer touch arrived meanwhile
+                with self._lock:
+                    for key, timestamp in touches.items():
+                        self._pending[key] = max(timestamp, self._pending.get(key, timestamp))
+                    self.failures += 1
+                self.app.logger.warning('Unable to flush %d lastUsed touches: %s', len(touches), e)
+                return 0
+
+            with self._lock:
+                self.flushed += len(touches)
+                self.flushes += 1
+
+            return len(touches)
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'touched': self.touched,
+            'coalesced': self.coalesced,
+            'flushed': self.flushed,
+            'flushes': self.flushes,
+            'failures': self.failures,
+        }
+
+
+touches = TouchBuffer()
@@ -0,0 +1,183 @@
+"""
+Bulk users import (JSONL or CSV of full_name, email and password) and export (JSONL of the stored documents).
+Both keep a checkpoint file next to their output/input, an interrupted run continues where it stopped.
+"""
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from bson import ObjectId
+from bson.json_util import dumps
+from pymongo.errors import BulkWriteError
+from werkzeug.security import generate_password_hash
+
+from .. import mongo
+from . import repository
+
+FIELDS = ('full_name', 'email', 'password')
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_checkpoint(path, state):
+    # replaced atomically, a crash leaves the previous checkpoint
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(state, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+
+def read_records(path, file_format=None):
+    """Users to import as dictionaries, from a JSONL (one object per line) or CSV (with header) file"""
+    file_format = file_format or ('csv' if path.endswith('.csv') else 'jsonl')
+    with open(path, newline='' if file_format == 'csv' else None) as records_file:
+        if file_format == 'csv':
+            yield from csv.DictReader(records_file)
+            return
+
+        for line in records_file:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+
+def _valid(record):
+    return isinstance(record, dict) and all(isinstance(record.get(field), str) and record.get(field).strip()
+                                            for field in FIELDS)
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(users):
+    """Insert without stopping at duplicates (another import or a signup may have taken an email)"""
+    try:
+        return len(mongo.db.users.insert_many(users, ordered=False).inserted_ids), 0
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != repository.DUPLICATE_KEY for error in errors):
+            raise
+        return e.details.get('nInserted', 0), len(errors)
+
+
+def import_users(path, file_format=None, batch_size=1000, workers=None, progress=print):
+    """
+    Create the users of the file as signup does (not verified email, current password), skipping invalid
+    records and emails already used. Passwords are hashed on a process pool, duplicates checked per batch
+    and users inserted unordered. Returns the totals.
+    """
+    checkpoint = path + '.checkpoint'
+    state = _read_checkpoint(checkpoint) or {'read': 0, 'imported': 0, 'duplicates': 0, 'invalid': 0}
+    if state['read']:
+        progress('Resuming after %d records' % state['read'])
+
+    started = time.time()
+    resumed = state['imported']
+    records = read_records(path, file_format)
+    for _ in range(state['read']):
+        next(records, None)
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        for batch in _batches(records, batch_size):
+            valid = []
+            seen = set()
+            for record in batch:
+                if not _valid(record):
+                    state['invalid'] += 1
+                elif repository.normalize_email(record.get('email')) in seen:
+                    state['duplicates'] += 1
+                else:
+                    seen.add(repository.normalize_email(record.get('email')))
+                    valid.append(record)
+
+            # emails used by any user, current or not (as signup checks)
+            used = set()
+            if valid:
+                for user in mongo.db.users.find({'all_emails': {'$in': list(seen)}}, {'_id': 0, 'all_emails': 1}):
+                    used.update(user.get('all_emails') or [])
+            new = [record for record in valid if repository.normalize_email(record.get('email')) not in used]
+            state['duplicates'] += len(valid) - len(new)
+
+            timestamp = datetime.now(timezone.utc)
+            hashes = executor.map(generate_password_hash, [record.get('password') for record in new],
+                                  chunksize=max(1, len(new) // (4 * (workers or os.cpu_count() or 1))))
+            users = [repository.new_user(record.get('full_name'), record.get('email'), password_hash, timestamp)
+                     for record, password_hash in zip(new, hashes)]
+
+            if users:
+                inserted, duplicates = _insert(users)
+                state['imported'] += inserted
+                state['duplicates'] += duplicates
+
+            state['read'] += len(batch)
+            _write_checkpoint(checkpoint, state)
+
+            elapsed = time.time() - started
+            progress('%(read)d read, %(imported)d imported, %(duplicates)d duplicates, %(invalid)d invalid' % state
+                     + ' (%.0f users/s)' % ((state['imported'] - resumed) / elapsed if elapsed else 0))
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return state
+
+
+def export_users(path, batch_size=1000, progress=print):
+    """
+    Write every user document (Mongo extended JSON, one per line) by _id order, a single batch in memory.
+    Returns the number of users written.
+    """
+    checkpoint = path + '.checkpoint'
+    state = _read_checkpoint(checkpoint)
+    last_id = None
+    exported = 0
+
+    if state:
+        # lines written after the last checkpoint are dropped, they are exported again
+        last_id = ObjectId(state['last_id']) if state.get('last_id') else None
+        exported = state['exported']
+        progress('Resuming after %d users' % exported)
+
+    started = time.time()
+    resumed = exported
+    with open(path, 'a' if state else 'w') as export_file:
+        if state:
+            export_file.truncate(state['offset'])
+            export_file.seek(state['offset'])
+
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id else {}
+            users = list(mongo.db.users.find(query).sort('_id', 1).limit(batch_size))
+            if not users:
+                break
+
+            export_file.write(''.join(dumps(user) + '\n' for user in users))
+            export_file.flush()
+
+            exported += len(users)
+            last_id = users[-1].get('_id')
+            _write_checkpoint(checkpoint, {'last_id': str(last_id), 'exported': exported, 'offset': export_file.tell()})
+
+            elapsed = time.time() - started
+            progress('%d exported (%.0f users/s)' % (exported, (exported - resumed) / elapsed if elapsed else 0))
+
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return exported
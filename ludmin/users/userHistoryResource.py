@@ -0,0 +1,46 @@
+from flask_restful import Resource
+
+from flask import g
+from ..common import offset_args
+from .userResource import requested_user
+from . import repository, sessions
+
+
+def _page(user_id, name, load):
+    """One page of the user's list (as the profile: own user or master token), with the next page offset"""
+    if not g.token.has_access('basics'):
+        return {'error': 'Not allowed'}, 401
+
+    user_id, full_access = requested_user(user_id)
+    if not full_access:
+        return {'error': 'Not allowed'}, 401
+
+    args = offset_args()
+    try:
+        items, next_offset = load(user_id, args.get('limit'), args.get('offset'))
+
+        # an empty page may be an unknown user
+        if not items and not repository.find_by_id(user_id, repository.ID_ONLY):
+            return {'error': 'Not found'}, 404
+    except Exception:
+        return {'error': 'Error loading user'}, 404
+
+    return {'success': True, name: items, 'next': next_offset}
+
+
+class UserDevicesResource(Resource):
+    def options(self, user_id):
+        pass
+
+    def get(self, user_id):
+        """Devices linked to the user, by last use"""
+        return _page(user_id, 'devices', sessions.page_for_user)
+
+
+class UserEmailsResource(Resource):
+    def options(self, user_id):
+        pass
+
+    def get(self, user_id):
+        """User's emails, the current one first then by last use"""
+        return _page(user_id, 'emails', repository.emails_page)
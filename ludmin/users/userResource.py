@@ -1,10 +1,46 @@
-from flask_restful import Resource, reqparse
-from flask_pymongo import ObjectId
-from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
-
-from flask import g
-from .. import mongo
+from flask_restful import Resource
+from datetime import datetime, timezone
+from pymongo.errors import DuplicateKeyError
+
+from flask import g, current_app
+from ..common import limiter, Schema, Field
+from .passwords import PasswordHistory
+from . import repository, sessions
+from .profiles import profiles, etag
+
+UPDATE = Schema(
+    Field('full_name'),
+    Field('email'),
+    Field('password'),
+    Field('password_confirmation'),
+    Field('current_password'),
+)
+
+
+def requested_user(user_id):
+    """
+    The id of the user asked for ('me' is the token's user) and whether the token can see (and update)
+    more than its public profile: only its own user, unless it is a master token
+    """
+    session_user_id = g.token.decoded.get('_id')
+
+    # alias for the current user
+    if user_id == 'me':
+        user_id = session_user_id
+
+    return user_id, user_id == session_user_id or g.token.has_access('master')
+
+
+def profile_summary(user, device_count, passwords):
+    """Full profile of an user loaded with PROFILE_SUMMARY, devices and emails are listed by their own endpoints"""
+    return {
+        'user_id': str(user.get('_id')),
+        'full_name': user.get('full_name'),
+        'current_email': (user.get('emails') or [{}])[0].get('email'),
+        'device_count': device_count,
+        'email_count': len(user.get('all_emails') or []),
+        'passwords': user.get('passwords') if passwords else None
+    }
 
 
 class UserResource(Resource):
@@ -17,48 +53,45 @@ class UserResource(Resource):
         if not g.token.has_access('basics'):
             return {'error': 'Not allowed'}, 401
 
-        session_user_id = g.token.decoded.get('_id')
+        # public profile when getting someone else profile and not master
+        user_id, full_access = requested_user(user_id)
+        public_profile = not full_access
 
-        # alias for the current user
-        if user_id == 'me':
-            user_id = session_user_id
+        # public profiles are cached, answered without a round trip
+        cached = profiles.get(user_id) if public_profile else None
+        if cached:
+            profile, profile_etag = cached
+            return profiles.conditional({'success': True, 'profile': profile}, profile_etag)
 
-        # try to load the user (without the password hashes)
+        # try to load the user (only the name for public profiles, never the emails nor the password hashes)
         try:
-            user = mongo.db.users.find_one({
-                    '_id': ObjectId(user_id)
-                }, {'passwords.password': 0})
+            user = repository.find_by_id(
+                user_id, repository.PUBLIC_PROFILE if public_profile else repository.PROFILE_SUMMARY
+            )
         except Exception:
             return {'error': 'Error loading user'}, 404
 
         if not user:
             return {'error': 'Not found'}, 404
 
-        # public profile when getting someone else profile and not master
-        if user_id != session_user_id and not g.token.has_access('master'):
-            return {
-                'success': True,
-                'profile': {
-                    'user_id': str(user.get('_id')),
-                    'full_name': user.get('full_name')
-                }
+        if public_profile:
+            profile = {
+                'user_id': str(user.get('_id')),
+                'full_name': user.get('full_name')
             }
+            profile_etag = profiles.set(str(user.get('_id')), profile)
+            return profiles.conditional({'success': True, 'profile': profile}, profile_etag)
 
-        # load full profile for self profile or master users
-        current_email = next((item for item in user.get('emails') if item.get('current') is True), None)
-
-        return {
+        # full profile for self profile or master users
+        body = {
             'success': True,
-            'profile': {
-                'user_id': str(user.get('_id')),
-                'full_name': user.get('full_name'),
-                'current_email': current_email.get('email'),
-                'devices': user.get('devices'),
-                'emails': user.get('emails'),
-                'passwords': user.get('passwords') if g.token.has_access('master') else None
-            }
+            'profile': profile_summary(
+                user, sessions.count_for_user(user.get('_id')), g.token.has_access('master')
+            )
         }
+        return profiles.conditional(body, etag(body))
 
+    @limiter.limit('user_update')
     def put(self, user_id):
         """ Update user details """
 
@@ -66,132 +99,105 @@ class UserResource(Resource):
             return {'error': 'Not allowed'}, 401
 
         # validate fields
-        parser = reqparse.RequestParser()
-        parser.add_argument('full_name')
-        parser.add_argument('email')
-        parser.add_argument('password')
-        parser.add_argument('password_confirmation')
-        parser.add_argument('current_password')
-        data = parser.parse_args()
-
-        session_user_id = g.token.decoded.get('_id')
-
-        # alias for the current user
-        if user_id == 'me':
-            user_id = session_user_id
+        data = UPDATE.parse()
 
         # not allow update other users unless is master
-        if user_id != session_user_id and not g.token.has_access('master'):
+        user_id, full_access = requested_user(user_id)
+        if not full_access:
             return {'error': 'Not allowed'}, 401
 
-        # load user (even with hashes, must load the full object to perform a full update later)
-        try:
-            user = mongo.db.users.find_one({
-                    '_id': ObjectId(user_id)
-                })
-        except Exception:
-            return {'error': 'Error loading user'}, 404
-
-        # if the current password is given, validate it (required later on for sensitive data changes)
-        verified_pass = False
-        if data.get('current_password'):
-            user_passwords = user.get('passwords') or []
-            for pass_to_check in user_passwords:
-                found = check_password_hash(pass_to_check.get('password'), data.get('current_password'))\
-                        and pass_to_check.get('current')
-                if found:
-                    verified_pass = True
-                    break
-
-        # start partial updates
-        current_date_time = datetime.now()
-        if data.get('full_name'):
-            user.update({
-                    'full_name': data.get('full_name')
-                })
-
-        # email update
-        if data.get('email'):
-            # email change requires current password
-            if not verified_pass:
-                return {'error': 'Unable to verify current password.'}, 401
-
-            # check email is already registered
-            email_exist_details = mongo.db.users.find_one({
-                'emails': {
-                    '$elemMatch': {'email': data.get('email')}
-                }
-            })
-
-            # we can not use the email if registered on other user
-            if email_exist_details and email_exist_details.get('_id') != user.get('_id'):
-                return {'error': 'Email already in use by other user.'}, 400
-
-            # append the new email if not already included on this user
-            user_emails = user.get('emails') or []
-            if not any(email.get('email') == data.get('email') for email in user_emails):
-                user_emails.append({
-                    'email': data.get('email'),
-                    'verified': False,
-                    'current': True,
-                    'insertedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-                })
-
-            # mark the new email as the current one and un-mark the previous one
-            for email_to_unflag in user_emails:
-                is_current = email_to_unflag.get('email') == data.get('email')
-
-                # was already used before, set an updatedAt
-                if is_current != email_to_unflag.get('current'):
-                    email_to_unflag.update({
-                        'updatedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
+        # changes are computed from the user as read and applied only if it was not changed meanwhile
+        current_date_time = datetime.now(timezone.utc)
+        for attempt in range(repository.UPDATE_ATTEMPTS):
+            # load user's passwords and emails (with hashes, required to validate the passwords)
+            try:
+                user = repository.find_by_id(user_id, repository.CREDENTIALS)
+            except Exception:
+                return {'error': 'Error loading user'}, 404
+
+            if not user:
+                return {'error': 'Not found'}, 404
+
+            # if the current password is given, validate it (required later on for sensitive data changes)
+            password_history = PasswordHistory(user.get('passwords'),
+                                               current_app.config.get('PASSWORD_HISTORY_LIMIT'))
+            verified_pass = False
+            if data.get('current_password'):
+                verified_pass = password_history.verify_current(data.get('current_password'))
+
+            # start partial updates, only the changed fields are sent to the db
+            updates = {}
+            unchanged = {}
+            if data.get('full_name'):
+                updates.update({
+                        'full_name': data.get('full_name')
                     })
 
-                # mark current or not
-                email_to_unflag.update({
-                        'current': is_current
+            # email update
+            if data.get('email'):
+                # email change requires current password
+                if not verified_pass:
+                    return {'error': 'Unable to verify current password.'}, 401
+
+                # append the new email if not already included on this user (emails are case insensitive)
+                new_email = repository.normalize_email(data.get('email'))
+                user_emails = [dict(email) for email in user.get('emails') or []]
+                if not any(repository.normalize_email(email.get('email')) == new_email for email in user_emails):
+                    user_emails.append({
+                        'email': data.get('email'),
+                        'verified': False,
+                        'current': True,
+                        'insertedAt': current_date_time,
                     })
 
-            user.update({'emails': user_emails})
-
-        # password is being updated
-        if data.get('password'):
-            # password change requires current password
-            if not verified_pass:
-                return {'error': 'Unable to verify current password.'}, 401
-
-            # validate the password
-            if data.get('password') != data.get('password_confirmation'):
-                return {'error': 'Password confirmation does not match.'}, 400
-
-            # append new password if not already used before
-            user_passwords = user.get('passwords') or []
-            if not any(check_password_hash(currentPassword.get('password'), data.get('password'))
-                       for currentPassword in user_passwords
-                       ):
-                user_passwords.append({
-                    'current': True,
-                    'password': generate_password_hash(data.get('password')),
-                    'insertedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-                })
-
-            # mark the current password
-            for pass_to_unflag in user_passwords:
-                is_current = check_password_hash(pass_to_unflag.get('password'), data.get('password'))
-
-                # is not the current but was already used, update hash
-                if is_current != pass_to_unflag.get('current'):
-                    pass_to_unflag.update({
-                            'updatedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
+                # mark the new email as the current one and un-mark the previous one
+                for email_to_unflag in user_emails:
+                    is_current = repository.normalize_email(email_to_unflag.get('email')) == new_email
+
+                    # was already used before, set an updatedAt
+                    if is_current != email_to_unflag.get('current'):
+                        email_to_unflag.update({
+                            'updatedAt': current_date_time,
                         })
 
-                # mark current or not
-                pass_to_unflag.update({
-                        'current': is_current
-                    })
+                    # mark current or not
+                    email_to_unflag.update({
+                            'current': is_current
+                        })
+
+                updates.update({'emails': user_emails})
+                updates.update(repository.email_fields(user_emails))
+                unchanged.update({'emails': user.get('emails')})
+
+            # password is being updated
+            if data.get('password'):
+                # password change requires current password
+                if not verified_pass:
+                    return {'error': 'Unable to verify current password.'}, 401
+
+                # validate the password
+                if data.get('password') != data.get('password_confirmation'):
+                    return {'error': 'Password confirmation does not match.'}, 400
+
+                # make it the current password, appended if not already used before
+                updates.update(password_history.use(
+                    data.get('password'),
+                    current_date_time
+                ))
+                unchanged.update(password_history.unchanged())
+
+            if not updates:
+                break
+
+            # send the changes to the db, the unique indexes reject an email already used by other user
+            try:
+                if repository.set_fields(user.get('_id'), updates, unchanged):
+                    break
+            except DuplicateKeyError:
+                return {'error': 'Email already in use by other user.'}, 400
+        else:
+            return {'error': 'User changed while updating, try again.'}, 409
 
-            user.update({'passwords': user_passwords})
+        profiles.invalidate(user.get('_id'))
 
-        # send the changes to the db
-        mongo.db.users.save(user)
         return {'success': True}
@@ -1,10 +1,19 @@
-from flask_restful import Resource, reqparse
+from flask_restful import Resource
 from flask_pymongo import ObjectId
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime, timedelta, timezone
-from werkzeug.security import generate_password_hash, check_password_hash
 
 from flask import g
-from .. import mongo
+from .. import hasher
+from ..common import page_args, InvalidCursor, limiter, Schema, Field
+from . import repository
+
+SIGNUP = Schema(
+    Field('full_name', required=True),
+    Field('email', required=True),
+    Field('password', required=True),
+    Field('password_confirmation', required=True),
+)
 
 
 class UsersResource(Resource):
@@ -17,57 +26,43 @@ class UsersResource(Resource):
         if not g.token.has_access('master'):
             return {'error': 'Not allowed'}, 401
 
-        # return raw list of users, just hide their password hashes
-        return {'success': True, 'users': mongo.db.users.find({}, {'_id': 0, 'passwords.password': 0})}
+        try:
+            args = page_args()
+        except InvalidCursor as e:
+            return {'error': str(e)}, 400
+
+        # raw list of users, just hide their password hashes
+        if args['stream']:
+            return repository.stream(args['stream_limit'], args['after'])
+
+        users, next_after = repository.page(args['limit'], args['after'])
+        return {'success': True, 'users': users, 'next': next_after}
 
+    @limiter.limit('signup')
     def post(self):
         """ Create new user"""
         if not g.token.has_access('public'):
             return { 'error': 'Not allowed' }, 401
 
         # validate fields
-        parser = reqparse.RequestParser()
-        parser.add_argument('full_name', required=True)
-        parser.add_argument('email', required=True)
-        parser.add_argument('password', required=True)
-        parser.add_argument('password_confirmation', required=True)
-        data = parser.parse_args()
+        data = SIGNUP.parse()
 
         if data.get('password') != data.get('password_confirmation'):
             return { 'error': 'Password confirmation does not match' }, 400
 
-        # we are not validating the user's email
-        verified_email = False
+        # create user (we are not validating the user's email)
+        current_date_time = datetime.now(timezone.utc)
+        new_user = repository.new_user(
+            data.get('full_name'),
+            data.get('email'),
+            hasher.generate(data.get('password')),
+            current_date_time
+        )
 
-        # check if email already in use
-        if mongo.db.users.find_one({
-            'emails': {
-                '$elemMatch': { 'email': data.get('email') }
-            }
-        }):
+        # the unique indexes reject emails already in use (by any user, current or not)
+        try:
+            repository.insert(new_user)
+        except DuplicateKeyError:
             return { 'error': 'Email already in use' }, 400
 
-        # create user
-        current_date_time = datetime.now(timezone.utc)
-        new_user = {
-            'full_name': data.get('full_name'),
-            'emails': [
-                {
-                    'email': data.get('email'),
-                    'verified': verified_email,
-                    'current': True,
-                    'insertedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-                }
-            ],
-            'passwords': [
-                {
-                    'current': True,
-                    'password': generate_password_hash(data.get('password')),
-                    'insertedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-                }
-            ],
-            'insertedAt': current_date_time.strftime('%Y-%m-%d %H:%M:%S'),
-            }
-
-        mongo.db.users.insert(new_user)
         return {'success': True}
\ No newline at end of file
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
+from flask import current_app
 from flask_script import Manager, Shell, Server
-from ludmin import create_app
+import json
+import os
+import sys
+from ludmin import create_app, mongo, indexes
+from ludmin import bench as benchmark
+from ludmin.users import repository, resets, sessions, timestamps, transfer
 
 manager = Manager(create_app)
 
@@ -9,5 +15,158 @@ manager.add_command(
     Server(host='0.0.0.0', port=8080)
 )
 
+
+@manager.command
+def ensure_indexes():
+    """Create the indexes required by the API queries"""
+    for collection, name in indexes.ensure_indexes(mongo.db):
+        print('%s: %s' % (collection, name))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+def migrate_sessions(batch_size):
+    """Move the devices embedded on the users into the sessions collection"""
+    moved_users, moved_devices = sessions.migrate_embedded_devices(batch_size)
+    print('%d devices moved from %d users' % (moved_devices, moved_users))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+def migrate_emails(batch_size):
+    """Set the normalized email lookup fields (current_email, all_emails) on the existing users"""
+    for collection, name in indexes.ensure_indexes(mongo.db):
+        print('%s: %s' % (collection, name))
+
+    updated, conflicts = repository.migrate_email_fields(batch_size)
+    print('%d users updated' % updated)
+    for user_id in conflicts:
+        print('Conflict: user %s shares an email with other user once normalized, fix it and run again' % user_id)
+
+    # replaced by the unique current_email and all_emails indexes
+    if not conflicts and 'emails_email_current' in mongo.db.users.index_information():
+        mongo.db.users.drop_index('emails_email_current')
+        print('users: emails_email_current dropped')
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=500)
+def migrate_timestamps(batch_size):
+    """Convert the timestamps stored as strings to dates (insertedAt, updatedAt, lastUsed)"""
+    migrated = timestamps.migrate(batch_size, current_app.config.get('RESET_CODE_TIMEOUT', 3600))
+    for collection, (converted, invalid) in migrated.items():
+        print('%s: %d converted, %d with unparseable timestamps' % (collection, converted, invalid))
+
+
+@manager.option('-d', '--days', dest='days', type=int, default=90)
+def remove_idle_devices(days):
+    """Unlink the devices not used for the given days"""
+    print('%d devices removed' % sessions.remove_idle(days))
+
+
+@manager.command
+def remove_expired_resets():
+    """Remove the expired reset requests (also removed by the TTL index, within a minute or so)"""
+    print('%d reset requests removed' % resets.remove_expired())
+
+
+@manager.option('-f', '--format', dest='file_format', choices=['jsonl', 'csv'], default=None,
+                help='by the file extension when not given')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000)
+@manager.option('-w', '--workers', dest='workers', type=int, default=None, help='hashing processes, all cores by default')
+@manager.option('path', help='JSONL or CSV file with full_name, email and password')
+def import_users(path, file_format, batch_size, workers):
+    """Create users in bulk, run it again with the same file to resume an interrupted import"""
+    totals = transfer.import_users(path, file_format, batch_size, workers)
+    print('%(imported)d users imported, %(duplicates)d duplicated emails and %(invalid)d invalid records skipped' % totals)
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000)
+@manager.option('path', help='JSONL output file')
+def export_users(path, batch_size):
+    """Write every user to a JSONL file, run it again with the same file to resume an interrupted export"""
+    print('%d users exported' % transfer.export_users(path, batch_size))
+
+
+@manager.option('-s', '--scenario', dest='scenarios', action='append', choices=benchmark.SCENARIOS,
+                help='scenario to run (repeat for several), all by default')
+@manager.option('-n', '--requests', dest='requests', type=int, default=200, help='requests per scenario')
+@manager.option('-u', '--users', dest='users', type=int, default=1000, help='seeded users')
+@manager.option('--mongo-uri', dest='mongo_uri', default=None,
+                help='disposable mongod database (dropped, must be named *bench*), mongomock by default')
+@manager.option('--set', dest='settings', action='append', default=[], help='config override KEY=VALUE')
+@manager.option('-o', '--output', dest='output', default=None, help='JSON results file, stdout by default')
+def bench(scenarios, requests, users, mongo_uri, settings, output):
+    """Benchmark the endpoints, prints throughput and p50/p99 latencies as JSON"""
+    overrides = {}
+    for setting in settings:
+        key, value = setting.split('=', 1)
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+
+    results = json.dumps(benchmark.run(scenarios, requests, users, mongo_uri=mongo_uri, overrides=overrides), indent=2)
+    if output:
+        with open(output, 'w') as results_file:
+            results_file.write(results)
+    else:
+        print(results)
+
+
+@manager.option('-H', '--host', dest='host', default='0.0.0.0')
+@manager.option('-p', '--port', dest='port', type=int, default=8081)
+def serve_tokens(host, port):
+    """Serve the /tokens routes on asyncio (aiohttp + motor), next to the WSGI server for the rest"""
+    from ludmin.tokens import aio
+    aio.serve(os.environ.get('LUDMIN_CONFIG', 'development'), host, port)
+
+
+@manager.option('--mongo-uri', dest='mongo_uri', required=True,
+                help='disposable mongod database (dropped, must be named *bench*)')
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=50)
+@manager.option('-n', '--requests', dest='requests', type=int, default=2000)
+@manager.option('-u', '--users', dest='users', type=int, default=1000, help='seeded users')
+def bench_refresh(mongo_uri, concurrency, requests, users):
+    """Concurrent refresh throughput, sync blueprint vs asyncio mode (JSON)"""
+    print(json.dumps(benchmark.compare_refresh(mongo_uri, concurrency, requests, users), indent=2))
+
+
+@manager.option('-n', '--repeat', dest='repeat', type=int, default=50, help='encodings per payload')
+@manager.option('-u', '--users', dest='users', type=int, default=1000, help='seeded users')
+def bench_json(repeat, users):
+    """Encoding time of the largest responses with each installed JSON encoder (JSON)"""
+    print(json.dumps(benchmark.compare_encoders(users, repeat=repeat), indent=2))
+
+
+@manager.option('-n', '--repeat', dest='repeat', type=int, default=2000, help='requests parsed per body')
+def bench_parsing(repeat):
+    """Request body parsing time, reqparse parsers built per request vs the precompiled schemas (JSON)"""
+    print(json.dumps(benchmark.compare_parsing(repeat), indent=2))
+
+
+@manager.option('-n', '--requests', dest='requests', type=int, default=500, help='requests per scenario')
+@manager.option('-u', '--users', dest='users', type=int, default=100, help='seeded users')
+def bench_tokens(requests, users):
+    """CPU time per request with and without the verified tokens cache (JSON)"""
+    print(json.dumps(benchmark.compare_tokens(requests, users), indent=2))
+
+
+@manager.option('-d', '--documents', dest='documents', type=int, default=100000, help='documents of the cursor')
+def bench_streaming(documents):
+    """Peak memory of a large cursor response, loaded at once vs streamed (JSON)"""
+    print(json.dumps(benchmark.compare_streaming(documents), indent=2))
+
+
+@manager.option('-l', '--length', dest='lengths', type=int, action='append', help='passwords per user (repeat)')
+@manager.option('-n', '--repeat', dest='repeat', type=int, default=3, help='password changes per case')
+def bench_passwords(lengths, repeat):
+    """Password change cost with long password histories, previous flow vs PasswordHistory (JSON)"""
+    print(json.dumps(benchmark.compare_password_history(lengths or (10, 50, 200), repeat), indent=2))
+
+
 if __name__ == '__main__':
-    manager.run()
+    # the production server is started before the manager creates an app: the workers create theirs
+    # after the fork, nothing (Mongo client, threads) can be created in the master
+    if sys.argv[1:2] == ['serve']:
+        from ludmin import serving
+        serving.main(sys.argv[2:])
+    else:
+        manager.run()
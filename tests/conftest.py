@@ -0,0 +1,30 @@
+"""
+Tests run against the testing config (config.py, as the app). The ones asserting on the queries sent to
+Mongo need a disposable mongod database: set LUDMIN_TEST_MONGO_URI (dropped, must be named *bench*).
+"""
+import os
+import pytest
+
+from ludmin import bench
+
+MONGO_URI = os.environ.get('LUDMIN_TEST_MONGO_URI')
+
+
+@pytest.fixture
+def mongod():
+    """(app, db, runner) on the disposable mongod database, seeded and with the indexes built"""
+    if not MONGO_URI:
+        pytest.skip('LUDMIN_TEST_MONGO_URI is not set')
+
+    app, db = bench.build_app(MONGO_URI)
+    runner = bench.Runner(app, db, bench.seed(db, users=20, devices=3, emails=2, passwords=1, resets=0.5))
+    yield app, db, runner
+    db.client.drop_database(db.name)
+
+
+@pytest.fixture
+def mocked():
+    """(app, db, runner) on an in-memory mongomock database, seeded"""
+    app, db = bench.build_app()
+    runner = bench.Runner(app, db, bench.seed(db, users=5, devices=2, emails=2, passwords=1, resets=0))
+    return app, db, runner
@@ -0,0 +1,49 @@
+def test_logout_every_device_and_one_device_of_the_same_user(mocked):
+    app, db, runner = mocked
+    user = runner.users[0]
+    device_id, token = runner.login(user)
+    devices = set(user.get('devices')) | {device_id}
+
+    status, data = runner.request('post', '/users/batch/logout', {'items': [
+        {'user_id': str(user.get('_id'))},
+        {'user_id': str(user.get('_id')), 'device_id': user.get('devices')[0]},
+    ]}, token)
+
+    assert status == 200
+    every, one = data.get('results')
+    assert every.get('success') and set(every.get('devices')) == devices
+    assert one.get('success') and one.get('devices') == [user.get('devices')[0]]
+    assert db.sessions.count_documents({'user_id': user.get('_id')}) == 0
+
+
+def test_logout_one_device(mocked):
+    app, db, runner = mocked
+    user = runner.users[0]
+    device_id, token = runner.login(user)
+
+    status, data = runner.request('post', '/users/batch/logout', {'items': [
+        {'user_id': str(user.get('_id')), 'device_id': user.get('devices')[0]},
+        {'user_id': str(user.get('_id')), 'device_id': 'unknown'},
+    ]}, token)
+
+    assert [result.get('devices') for result in data.get('results')] == [[user.get('devices')[0]], None]
+    assert data.get('results')[1].get('error') == 'Device not linked to user.'
+    assert db.sessions.count_documents({'user_id': user.get('_id')}) == len(user.get('devices'))
+
+
+def test_profiles_as_the_full_profile(mocked):
+    app, db, runner = mocked
+    user, other = runner.users[:2]
+    device_id, token = runner.login(user)
+
+    status, data = runner.request('post', '/users/batch/profiles', {
+        'user_ids': [str(user.get('_id')), str(other.get('_id')), 'invalid'],
+    }, token)
+    assert status == 200
+    first, second, invalid = data.get('results')
+
+    assert first.get('profile') == runner.request('get', '/users/me', token=token)[1].get('profile')
+    assert second.get('profile').get('current_email') == other.get('email')
+    assert second.get('profile').get('device_count') == len(other.get('devices'))
+    assert 'emails' not in second.get('profile') and 'devices' not in second.get('profile')
+    assert invalid.get('error') == 'Invalid id'
@@ -0,0 +1,27 @@
+from ludmin import bench
+from ludmin.common import limiter
+from ludmin.querylog import query_log
+from ludmin.tokens.token import token_cache
+from ludmin.users.profiles import profiles
+
+
+def test_overrides_configure_every_extension():
+    bench.build_app(overrides={
+        'TOKEN_CACHE_SIZE': 0,
+        'PROFILE_CACHE_TTL': 0,
+        'RATE_LIMITS': {'login': {'ip': (1, 60)}},
+        'SLOW_QUERY_MS': 5,
+    })
+
+    assert token_cache.max_size == 0
+    assert profiles.ttl == 0
+    assert limiter.rates == {'login': {'ip': (1, 60)}}
+    assert query_log.slow_ms == 5
+
+
+def test_run_with_overrides():
+    results = bench.run(['profile'], requests=5, users=3, devices=1, emails=1, passwords=1,
+                        overrides={'TOKEN_CACHE_SIZE': 0})
+
+    assert results['results']['profile']['statuses'] == {'200': 5}
+    assert token_cache.stats()['hits'] == 0
@@ -0,0 +1,39 @@
+from datetime import datetime, timezone
+
+from ludmin.users import repository
+
+
+def test_email_change_keeps_an_email_added_meanwhile(mocked, monkeypatch):
+    app, db, runner = mocked
+    user = runner.users[0]
+    device_id, token = runner.login(user)
+
+    # another request adds an email after the user was read for this change
+    find_by_id = repository.find_by_id
+    writes = []
+
+    def concurrent_change(user_id, projection=None):
+        found = find_by_id(user_id, projection)
+        if not writes:
+            writes.append(db.users.update_one({'_id': user.get('_id')}, {
+                '$push': {'emails': {'email': 'Other@bench.test', 'verified': False, 'current': False,
+                                     'insertedAt': datetime.now(timezone.utc)}},
+                '$addToSet': {'all_emails': 'other@bench.test'},
+            }))
+        return found
+
+    monkeypatch.setattr(repository, 'find_by_id', concurrent_change)
+    status, data = runner.request('put', '/users/me', {
+        'email': 'Changed@bench.test',
+        'current_password': user.get('password'),
+    }, token)
+
+    # the change is applied on the emails loaded again
+    assert (status, data) == (200, {'success': True})
+    stored = db.users.find_one({'_id': user.get('_id')})
+    emails = {email.get('email'): email.get('current') for email in stored.get('emails')}
+    assert emails['Other@bench.test'] is False
+    assert emails['Changed@bench.test'] is True
+    assert list(emails.values()).count(True) == 1
+    assert stored.get('current_email') == 'changed@bench.test'
+    assert {'other@bench.test', 'changed@bench.test'} <= set(stored.get('all_emails'))
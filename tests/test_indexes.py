@@ -0,0 +1,136 @@
+"""Every query sent by the endpoints is served by an index, checked with explain (needs a mongod)"""
+import uuid
+from contextlib import contextmanager
+from bson.son import SON
+from pymongo import monitoring
+
+from ludmin import bench
+from ludmin.users import resets, sessions
+
+# commands that can be explained, update and delete statements are explained one by one
+EXPLAINED = {'find', 'count', 'distinct', 'aggregate', 'findAndModify', 'update', 'delete'}
+
+# driver fields added to the commands, not accepted by explain
+DRIVER_FIELDS = {'lsid', 'txnNumber', 'writeConcern', 'readConcern'}
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Commands sent while recording, by the clients created after its registration (at import)"""
+    def __init__(self):
+        self.commands = None
+
+    @contextmanager
+    def recording(self):
+        self.commands = []
+        try:
+            yield self.commands
+        finally:
+            self.commands = None
+
+    def started(self, event):
+        if self.commands is not None and event.command_name in EXPLAINED:
+            self.commands.append((event.command_name, event.command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+recorder = CommandRecorder()
+monitoring.register(recorder)
+
+
+def explainable(name, command):
+    """The recorded command as explain commands, one per update or delete statement"""
+    fields = [(key, value) for key, value in command.items()
+              if key != name and not key.startswith('$') and key not in DRIVER_FIELDS]
+
+    statements = {'update': 'updates', 'delete': 'deletes'}.get(name)
+    if statements is None:
+        return [SON([('explain', SON([(name, command[name])] + fields)), ('verbosity', 'queryPlanner')])]
+
+    return [
+        SON([('explain', SON([(name, command[name])] + [
+            (key, [statement] if key == statements else value) for key, value in fields
+        ])), ('verbosity', 'queryPlanner')])
+        for statement in command[statements]
+    ]
+
+
+def plan_stages(explain):
+    """Stages of the winning plans found anywhere in the explain output"""
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'stage' and isinstance(value, str):
+                yield value
+            elif key != 'rejectedPlans':
+                yield from plan_stages(value)
+    elif isinstance(explain, list):
+        for item in explain:
+            yield from plan_stages(item)
+
+
+def is_index_plan(stages):
+    return 'COLLSCAN' not in stages and any('IXSCAN' in stage or stage in ('IDHACK', 'COUNT_SCAN')
+                                            for stage in stages)
+
+
+def test_endpoint_queries_use_indexes(mongod):
+    app, db, runner = mongod
+    user, other = runner.users[:2]
+
+    with recorder.recording() as commands:
+        statuses = [runner.scenario(name)()[0] for name in bench.SCENARIOS]
+
+        device_id, token = runner.login(user)
+        statuses.append(runner.request('post', '/users', {
+            'full_name': 'New User',
+            'email': 'new.user@bench.test',
+            'password': 'password',
+            'password_confirmation': 'password',
+        }, runner.public_token())[0])
+        statuses.append(runner.request('get', '/users/%s' % other.get('_id'), token=token)[0])
+        statuses.append(runner.request('get', '/users/me', token=token)[0])
+        statuses.append(runner.request('get', '/users/reset?limit=10', token=token)[0])
+        statuses.append(runner.request('post', '/users/batch/profiles', {
+            'user_ids': [str(item.get('_id')) for item in runner.users[:5]],
+        }, token)[0])
+        statuses.append(runner.request('put', '/users/batch/names', {
+            'items': [{'user_id': str(other.get('_id')), 'full_name': 'Renamed'}],
+        }, token)[0])
+        statuses.append(runner.request('post', '/users/batch/logout', {
+            'items': [{'user_id': str(other.get('_id'))}],
+        }, token)[0])
+        statuses.append(runner.request('put', '/users/me', {
+            'email': 'changed.%s@bench.test' % uuid.uuid4().hex,
+            'password': 'new-password',
+            'password_confirmation': 'new-password',
+            'current_password': user.get('password'),
+        }, token)[0])
+        statuses.append(runner.request('delete', '/tokens/%s' % device_id, token=token)[0])
+
+        # housekeeping commands
+        with app.app_context():
+            resets.remove_expired()
+            sessions.remove_idle(365)
+
+    assert all(status < 400 for status in statuses), statuses
+    assert commands
+
+    for name, command in commands:
+        for explain_command in explainable(name, command):
+            stages = set(plan_stages(db.command(explain_command)))
+            assert is_index_plan(stages), (name, command, stages)
+
+
+def test_devices_page_is_not_sorted_in_memory(mongod):
+    app, db, runner = mongod
+
+    with recorder.recording() as commands, app.app_context():
+        sessions.page_for_user(runner.users[0].get('_id'), 2, 1)
+
+    (name, command), = commands
+    stages = set(plan_stages(db.command(explainable(name, command)[0])))
+    assert is_index_plan(stages) and 'SORT' not in stages, stages
@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+from werkzeug.security import generate_password_hash
+
+from ludmin.users import repository
+
+
+def test_password_change_keeps_a_password_set_meanwhile(mocked, monkeypatch):
+    app, db, runner = mocked
+    user = runner.users[0]
+    device_id, token = runner.login(user)
+    other_hash = generate_password_hash('other-password')
+
+    # another worker sets a new password after the user was read for this change
+    find_by_id = repository.find_by_id
+    writes = []
+
+    def concurrent_change(user_id, projection=None):
+        found = find_by_id(user_id, projection)
+        if not writes:
+            writes.append(db.users.update_one({'_id': user.get('_id')}, {
+                '$set': {'passwords.0.current': False},
+                '$push': {'passwords': {'current': True, 'password': other_hash,
+                                        'insertedAt': datetime.now(timezone.utc)}},
+            }))
+        return found
+
+    monkeypatch.setattr(repository, 'find_by_id', concurrent_change)
+    status, data = runner.request('put', '/users/me', {
+        'password': 'new-password',
+        'password_confirmation': 'new-password',
+        'current_password': user.get('password'),
+    }, token)
+
+    # the change is checked again against the password set meanwhile, which is kept
+    assert (status, data) == (401, {'error': 'Unable to verify current password.'})
+    passwords = db.users.find_one({'_id': user.get('_id')}).get('passwords')
+    assert [item.get('password') == other_hash for item in passwords] == [False, True]
+    assert [item.get('current') for item in passwords] == [False, True]
+
+
+def test_reset_keeps_a_password_set_meanwhile(mocked, monkeypatch):
+    app, db, runner = mocked
+    user = runner.users[0]
+    other_hash = generate_password_hash('other-password')
+    assert runner.request('post', '/users/reset', {'email': user.get('email')}, runner.public_token())[0] == 200
+    code = db.reset_requests.find_one({'email': user.get('email').lower(), 'enabled': True}).get('code')
+
+    # another worker sets a new password after the user was read for the reset
+    find_by_current_email = repository.find_by_current_email
+
+    def concurrent_change(email, projection=None):
+        found = find_by_current_email(email, projection)
+        db.users.update_one({'_id': user.get('_id')}, {
+            '$set': {'passwords.0.current': False},
+            '$push': {'passwords': {'current': True, 'password': other_hash,
+                                    'insertedAt': datetime.now(timezone.utc)}},
+        })
+        return found
+
+    monkeypatch.setattr(repository, 'find_by_current_email', concurrent_change)
+    status, data = runner.request('put', '/users/reset', {
+        'email': user.get('email'),
+        'code': code,
+        'password': 'new-password',
+        'password_confirmation': 'new-password',
+    }, runner.public_token())
+
+    # the reset is applied on the passwords loaded again
+    assert (status, data) == (200, {'success': True})
+    passwords = db.users.find_one({'_id': user.get('_id')}).get('passwords')
+    assert [item.get('password') == other_hash for item in passwords] == [False, True, False]
+    assert [item.get('current') for item in passwords] == [False, False, True]
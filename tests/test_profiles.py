@@ -0,0 +1,20 @@
+def test_full_profile_summary(mocked):
+    app, db, runner = mocked
+    status, data = runner.request('post', '/users', {
+        'full_name': 'Mixed Case',
+        'email': 'Mixed.Case@Example.com',
+        'password': 'password',
+        'password_confirmation': 'password',
+    }, runner.public_token())
+    assert status == 200
+
+    user = {'email': 'mixed.case@example.com', 'password': 'password'}
+    device_id, token = runner.login(user)
+    status, data = runner.request('get', '/users/me', token=token)
+
+    assert status == 200
+    profile = data.get('profile')
+    assert profile.get('current_email') == 'Mixed.Case@Example.com'
+    assert (profile.get('device_count'), profile.get('email_count')) == (1, 1)
+    assert [set(password) for password in profile.get('passwords')] == [{'current', 'insertedAt'}]
+    assert 'emails' not in profile and 'devices' not in profile
@@ -0,0 +1,166 @@
+"""
+Queries per endpoint, a change adding queries to an endpoint fails here: database round trips counted by
+the repositories (X-DB-Round-Trips header) and every command sent to mongomock, or the commands recorded
+by the query log (mongod).
+"""
+import json
+import threading
+import uuid
+
+import mongomock
+import pytest
+from flask import has_request_context
+
+from ludmin.querylog import query_log
+from ludmin.tokens.token import Token
+
+# max database round trips per request (lastUsed is written on every refresh by the testing config)
+ROUND_TRIPS = {
+    'public_token': 0,
+    'login': 2,
+    'refresh': 3,
+    'logout': 1,
+    'signup': 1,
+    'own_profile': 2,
+    'public_profile': 1,
+    'cached_public_profile': 0,
+    'devices': 1,
+    'emails': 1,
+    'list': 1,
+    'update_name': 2,
+    'update_email': 2,
+    'batch_profiles': 2,
+    'batch_names': 2,
+    'batch_logout': 2,
+    'reset_request': 3,
+    'reset': 3,
+    'reset_list': 1,
+}
+
+
+# mongomock collection methods sending a command to the server (cursors are read by the find)
+COMMANDS = ('find', 'find_one', 'find_one_and_update', 'find_one_and_delete', 'find_one_and_replace', 'insert_one',
+            'insert_many', 'update_one', 'update_many', 'replace_one', 'delete_one', 'delete_many', 'bulk_write',
+            'aggregate', 'count', 'count_documents', 'estimated_document_count', 'distinct')
+
+
+class MockCommands:
+    """Commands sent to mongomock by the requests, the calls made by mongomock itself are not counted"""
+    def __init__(self):
+        self.count = 0
+        self._local = threading.local()
+
+    def counted(self, method):
+        def command(collection, *args, **kwargs):
+            outer = not getattr(self._local, 'depth', 0)
+            if outer and has_request_context():
+                self.count += 1
+
+            self._local.depth = getattr(self._local, 'depth', 0) + 1
+            try:
+                return method(collection, *args, **kwargs)
+            finally:
+                self._local.depth -= 1
+
+        return command
+
+
+@pytest.fixture
+def mock_commands(monkeypatch):
+    commands = MockCommands()
+    for name in COMMANDS:
+        monkeypatch.setattr(mongomock.Collection, name, commands.counted(getattr(mongomock.Collection, name)))
+    return commands
+
+
+def endpoint_requests(app, db, runner):
+    """(name, request) of every endpoint, in order (requests depend on the previous ones)"""
+    user, other = runner.users[:2]
+    device_id, token = runner.login(user)
+    logout_device_id, logout_token = runner.login(user)
+    with app.app_context():
+        basics = Token(app.config, None).generate_logged(user, uuid.uuid4().hex, ['basics'], 1).decode('utf-8')
+
+    def call(method, url, body=None, token=None):
+        return getattr(runner.client, method)(
+            url,
+            data=json.dumps(body) if body is not None else None,
+            content_type='application/json',
+            headers={'Authorization': 'Bearer %s' % token} if token else {}
+        )
+
+    def reset():
+        code = db.reset_requests.find_one({'email': other.get('email').lower(), 'enabled': True}).get('code')
+        return call('put', '/users/reset', {
+            'email': other.get('email'),
+            'code': code,
+            'password': 'new-password',
+            'password_confirmation': 'new-password',
+        }, runner.public_token())
+
+    return [
+        ('public_token', lambda: call('post', '/tokens/public', {'device_id': uuid.uuid4().hex})),
+        ('login', lambda: call('post', '/tokens', {
+            'email': user.get('email'), 'password': user.get('password'), 'description': 'Test',
+        }, runner.public_token())),
+        ('refresh', lambda: call('get', '/tokens/%s' % device_id, token=token)),
+        ('logout', lambda: call('delete', '/tokens/%s' % logout_device_id, token=logout_token)),
+        ('signup', lambda: call('post', '/users', {
+            'full_name': 'New User', 'email': 'new.user@bench.test', 'password': 'password',
+            'password_confirmation': 'password',
+        }, runner.public_token())),
+        ('own_profile', lambda: call('get', '/users/me', token=token)),
+        ('public_profile', lambda: call('get', '/users/%s' % other.get('_id'), token=basics)),
+        ('cached_public_profile', lambda: call('get', '/users/%s' % other.get('_id'), token=basics)),
+        ('devices', lambda: call('get', '/users/me/devices', token=token)),
+        ('emails', lambda: call('get', '/users/me/emails', token=token)),
+        ('list', lambda: call('get', '/users?limit=10', token=token)),
+        ('update_name', lambda: call('put', '/users/me', {'full_name': 'Renamed'}, token)),
+        ('update_email', lambda: call('put', '/users/me', {
+            'email': 'changed@bench.test', 'current_password': user.get('password'),
+        }, token)),
+        ('batch_profiles', lambda: call('post', '/users/batch/profiles', {
+            'user_ids': [str(item.get('_id')) for item in runner.users],
+        }, token)),
+        ('batch_names', lambda: call('put', '/users/batch/names', {
+            'items': [{'user_id': str(other.get('_id')), 'full_name': 'Renamed'}],
+        }, token)),
+        ('batch_logout', lambda: call('post', '/users/batch/logout', {
+            'items': [{'user_id': str(other.get('_id'))}],
+        }, token)),
+        ('reset_request', lambda: call('post', '/users/reset', {'email': other.get('email')}, runner.public_token())),
+        ('reset', reset),
+        ('reset_list', lambda: call('get', '/users/reset?limit=10', token=token)),
+    ]
+
+
+def test_round_trips_per_endpoint(mocked, mock_commands):
+    app, db, runner = mocked
+
+    over = []
+    for name, request in endpoint_requests(app, db, runner):
+        sent = mock_commands.count
+        response = request()
+        assert response.status_code < 400, (name, response.get_data(as_text=True))
+
+        # every command is counted, also the ones sent without the repositories' round trip wrapper
+        round_trips = int(response.headers.get('X-DB-Round-Trips'))
+        commands = mock_commands.count - sent
+        if max(round_trips, commands) > ROUND_TRIPS[name]:
+            over.append((name, round_trips, commands, ROUND_TRIPS[name]))
+
+    assert not over
+
+
+def test_commands_per_endpoint(mongod):
+    app, db, runner = mongod
+
+    for name, request in endpoint_requests(app, db, runner):
+        with query_log.capture() as queries:
+            response = request()
+        assert response.status_code < 400, (name, response.get_data(as_text=True))
+
+        # the write-behind flushes may run in the same block, not from the endpoint
+        endpoint_queries = [query for query in queries if query.endpoint is not None]
+        assert len(endpoint_queries) <= app.config['QUERY_BUDGET'], (name, endpoint_queries)
+        assert not queries.unindexed(), (name, queries.unindexed())
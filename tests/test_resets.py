@@ -0,0 +1,16 @@
+def test_reset_of_an_email_no_longer_current_keeps_the_code(mocked):
+    app, db, runner = mocked
+    user = runner.users[0]
+    assert runner.request('post', '/users/reset', {'email': user.get('email')}, runner.public_token())[0] == 200
+    request = db.reset_requests.find_one({'email': user.get('email').lower(), 'enabled': True})
+
+    db.users.update_one({'_id': user.get('_id')}, {'$set': {'current_email': 'other@bench.test'}})
+    status, data = runner.request('put', '/users/reset', {
+        'email': user.get('email'),
+        'code': request.get('code'),
+        'password': 'new-password',
+        'password_confirmation': 'new-password',
+    }, runner.public_token())
+
+    assert (status, data) == (400, {'error': 'Unable to find active email.'})
+    assert db.reset_requests.find_one({'_id': request.get('_id')}).get('enabled') is True
@@ -0,0 +1,44 @@
+from ludmin.tokens.token import Token
+
+
+def _logged_token(app, user, device_id, rev):
+    with app.app_context():
+        return Token(app.config, None).generate_logged(user, device_id, ['basics', 'master'], rev).decode('utf-8')
+
+
+def test_refresh_of_a_rev_rotated_by_other_worker(mocked):
+    app, db, runner = mocked
+    user = runner.users[0]
+    device_id, token = runner.login(user)
+
+    # other worker rotated the rev
+    db.sessions.update_one({'user_id': user['_id'], 'device_id': device_id}, {'$set': {'rev': 4321}})
+    token = _logged_token(app, {'_id': user['_id'], 'full_name': 'User'}, device_id, 4321)
+
+    status, data = runner.request('get', '/tokens/%s' % device_id, token=token)
+    assert status == 200
+    assert data.get('type') == 'Refresh'
+
+
+def test_refresh_of_a_replaced_rev_is_rejected(mocked):
+    app, db, runner = mocked
+    user = runner.users[0]
+    device_id, token = runner.login(user)
+    assert runner.request('get', '/tokens/%s' % device_id, token=token)[1].get('type') == 'Refresh'
+
+    status, data = runner.request('get', '/tokens/%s' % device_id, token=token)
+    assert data.get('type') == 'Public'
+
+
+def test_logout_of_a_device_linked_again_by_other_worker(mocked):
+    app, db, runner = mocked
+    user = runner.users[0]
+    device_id, token = runner.login(user)
+    assert runner.request('delete', '/tokens/%s' % device_id, token=token)[1] == {'success': True}
+
+    # logged-in again through other worker
+    db.sessions.insert_one({'user_id': user['_id'], 'device_id': device_id, 'rev': 1234})
+    token = _logged_token(app, {'_id': user['_id'], 'full_name': 'User'}, device_id, 1234)
+
+    assert runner.request('delete', '/tokens/%s' % device_id, token=token)[1] == {'success': True}
+    assert db.sessions.count_documents({'user_id': user['_id'], 'device_id': device_id}) == 0